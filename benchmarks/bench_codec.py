@@ -0,0 +1,77 @@
+"""
+Encode and decode throughput of each installed JSON backend of lib.codec on
+protocol frames: get_chats, a get_messages page, new_message, get_updates and
+a status_change. Pass --recorded with a file of real frames, one JSON document
+per line, to measure those instead.
+
+    python -m benchmarks.bench_codec [--rounds 200] [--recorded frames.jsonl]
+"""
+import argparse
+import random
+import time
+
+from lib import codec
+
+
+def user(i: int) -> dict:
+    return {
+        "username": f"user{i}", "email": f"user{i}@example.com", "id": f"user-{i}", "last_seen": 1700000000.0 + i,
+        "full_name": f"User Number {i}", "display_name": f"User {i}", "avatar": None, "is_online": i % 3 == 0,
+    }
+
+
+def message(i: int, chat_id: str = "chat-1") -> dict:
+    return {
+        "id": f"m{i}", "text": "lorem ipsum dolor sit amet " * random.randint(1, 6), "sender": f"user-{i % 2}",
+        "time": 1700000000.0 + i, "status": random.choice(["sent", "read"]), "chat_id": chat_id,
+        "reply_to": None, "local_id": None,
+    }
+
+
+def synthetic_frames() -> dict:
+    random.seed(1)
+    chats = [{"id": f"chat-{i}", "last_message": "see you", "updated_at": 1700000000.0 + i, "user": user(i)} for i in range(100)]
+    updates = [{"type": "new_message", "body": {"message": message(i, f"chat-{i % 10}")}} for i in range(300)]
+    return {
+        "get_chats": {"action": "get_chats", "success": True, "data": {"results": chats}},
+        "get_messages": {"action": "get_messages", "success": True, "data": {"chat": {"id": "chat-1"}, "results": [message(i) for i in range(50)], "has_more": True}},
+        "new_message": {"action": "new_message", "success": True, "data": {"message": message(1), "local_id": None}},
+        "get_updates": {"action": "get_updates", "success": True, "data": {"updates": updates}},
+        "status_change": {"action": "status_change", "data": {"user_id": "user-1", "status": "online", "last_seen": 1700000000.0}},
+    }
+
+
+def recorded_frames(path: str) -> dict:
+    with open(path, "rb") as f:
+        frames = [codec.loads(line) for line in f if line.strip()]
+    return {f"{i}:{frame.get('action')}": frame for i, frame in enumerate(frames)}
+
+
+def throughput(fn, payload_bytes: int, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return payload_bytes * rounds / (time.perf_counter() - started) / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--recorded")
+    args = parser.parse_args()
+    frames = recorded_frames(args.recorded) if args.recorded else synthetic_frames()
+
+    print(f"MiB/s over {args.rounds} rounds, backends installed: {', '.join(codec.BACKENDS)}")
+    print(f"{'frame':<16} {'bytes':>8} {'backend':<8} {'encode':>9} {'decode':>9}")
+    for name, frame in frames.items():
+        for backend in codec.BACKENDS:
+            codec.use(backend)
+            encoded = codec.dumps(frame)
+            encode = throughput(lambda: codec.dumps(frame), len(encoded), args.rounds)
+            decode = throughput(lambda: codec.loads(encoded), len(encoded), args.rounds)
+            print(f"{name:<16} {len(encoded):>8} {backend:<8} {encode:>9.1f} {decode:>9.1f}")
+    codec.use("auto")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Per operation cost of MessageCollection against the plain list chat histories
+used to be, from 1k to 1M messages in a chat.
+
+    python -m benchmarks.bench_collection [--sizes 1000 10000 100000 1000000] [--ops 200]
+"""
+import argparse
+import random
+import time
+
+from chat_types import MessageType
+from utils.message_collection import MessageCollection
+
+
+def synthetic_messages(count: int):
+    return [MessageType(id=f"m{i}", text="hi", sender="u", time=float(i * 10), status="sent") for i in range(count)]
+
+
+def per_op(fn, ops: int) -> float:
+    started = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return (time.perf_counter() - started) / ops * 1_000_000
+
+
+def list_find(messages, message_id):
+    for message in messages:
+        if message.id == message_id:
+            return message
+    return None
+
+
+def list_insert(messages, message):
+    # what upsert did: append and sort when out of order
+    messages.append(message)
+    messages.sort(key=lambda message: message.time)
+
+
+def bench_list(count: int, ops: int) -> dict:
+    messages = synthetic_messages(count)
+    ids = [f"m{random.randrange(count)}" for _ in range(ops)]
+    return {
+        "lookup": per_op(lambda i: list_find(messages, ids[i]), ops),
+        "append": per_op(lambda i: messages.append(MessageType(f"n{i}", "", "u", count * 10.0 + i)), ops),
+        "insert": per_op(lambda i: list_insert(messages, MessageType(f"o{i}", "", "u", random.randrange(count) * 10 + 5.0)), ops),
+        "prepend 50": per_op(lambda i: messages.__setitem__(slice(0, 0), [MessageType(f"p{i}-{j}", "", "u", -1.0 - i * 100 + j) for j in range(50)]) or messages.sort(key=lambda message: message.time), ops),
+        "remove": per_op(lambda i: messages.remove(list_find(messages, ids[i])) if list_find(messages, ids[i]) else None, ops),
+    }
+
+
+def bench_collection(count: int, ops: int) -> dict:
+    collection = MessageCollection(synthetic_messages(count))
+    ids = [f"m{random.randrange(count)}" for _ in range(ops)]
+    return {
+        "lookup": per_op(lambda i: collection.get(ids[i]), ops),
+        "append": per_op(lambda i: collection.add(MessageType(f"n{i}", "", "u", count * 10.0 + i)), ops),
+        "insert": per_op(lambda i: collection.add(MessageType(f"o{i}", "", "u", random.randrange(count) * 10 + 5.0)), ops),
+        "prepend 50": per_op(lambda i: collection.prepend([MessageType(f"p{i}-{j}", "", "u", -1.0 - i * 100 - 50 + j) for j in range(50)]), ops),
+        "remove": per_op(lambda i: collection.remove(ids[i]), ops),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--ops", type=int, default=200)
+    args = parser.parse_args()
+    random.seed(1)
+
+    print(f"microseconds per operation, {args.ops} operations each")
+    print(f"{'messages':>9} {'operation':<11} {'list':>12} {'collection':>12}")
+    for count in args.sizes:
+        baseline = bench_list(count, args.ops)
+        indexed = bench_collection(count, args.ops)
+        for operation in baseline:
+            print(f"{count:>9} {operation:<11} {baseline[operation]:>12.1f} {indexed[operation]:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Bytes on the wire and time taken for large get_chats and get_messages frames
+sent by a local websocket server to a Conn, with permessage-deflate off and at
+several zlib levels. `link` adds the time those bytes take over a slow link
+(--link-kbps), to weigh CPU against bandwidth. Pass --recorded with a file of
+real frames, one JSON document per line, to replay those instead.
+
+    python -m benchmarks.bench_compression [--repeat 20] [--link-kbps 2000] [--runs 3] [--recorded frames.jsonl]
+"""
+import argparse
+import asyncio
+import random
+import threading
+import time
+from typing import List, Optional
+
+from websockets.asyncio.server import serve
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+from benchmarks.bench_codec import message, recorded_frames, user
+from lib import codec
+from lib.conn import Conn
+
+LEVELS = [None, 1, 3, 6, 9]
+
+
+def synthetic_frames(repeat: int, chats: int, messages: int) -> List[bytes]:
+    # different content every time, so compression can't just point back at the previous frame
+    frames = []
+    for i in range(repeat):
+        random.seed(i)
+        offset = i * 1000
+        frames.append(codec.dumps({"action": "get_chats", "success": True, "data": {"results": [
+            {"id": f"chat-{offset + j}", "last_message": "see you", "updated_at": 1700000000.0 + j, "user": user(offset + j)}
+            for j in range(chats)
+        ]}}))
+        frames.append(codec.dumps({"action": "get_messages", "success": True, "data": {
+            "chat": {"id": f"chat-{i}"}, "results": [message(offset + j, f"chat-{i}") for j in range(messages)], "has_more": True,
+        }}))
+    return frames
+
+
+def run_server(frames: List[bytes], level: Optional[int], window_bits: int, ready: threading.Event, port: list, done: threading.Event):
+    async def replay(websocket):
+        for frame in frames:
+            await websocket.send(frame, text=True)
+        await websocket.wait_closed()
+
+    async def main():
+        extensions = None
+        if level is not None:
+            extensions = [ServerPerMessageDeflateFactory(
+                server_max_window_bits=window_bits,
+                client_max_window_bits=window_bits,
+                compress_settings={"level": level, "memLevel": 5},
+            )]
+        async with serve(replay, "127.0.0.1", 0, compression=None, extensions=extensions) as server:
+            port.append(server.sockets[0].getsockname()[1])
+            ready.set()
+            await asyncio.get_running_loop().run_in_executor(None, done.wait)
+
+    asyncio.run(main())
+
+
+def replay(frames: List[bytes], level: Optional[int], window_bits: int) -> tuple:
+    ready, done, port = threading.Event(), threading.Event(), []
+    server = threading.Thread(target=run_server, args=(frames, level, window_bits, ready, port, done))
+    server.start()
+    ready.wait()
+
+    received = []
+    started = []
+    conn = Conn("127.0.0.1", str(port[0]), compression=level)
+    conn.connected_callback = lambda: started.append(time.perf_counter())
+
+    def on_message(data):
+        received.append(data)
+        if len(received) == len(frames):
+            started.append(time.perf_counter())
+            done.set()
+
+    conn.on_message_callback = on_message
+    conn.start()
+    done.wait()
+    elapsed = started[-1] - started[0]
+    conn.stop()
+    server.join()
+    return conn.traffic_stats(), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--chats", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--window-bits", type=int, default=12)
+    parser.add_argument("--link-kbps", type=float, default=2000)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--recorded")
+    args = parser.parse_args()
+    if args.recorded:
+        frames = [codec.dumps(frame) for frame in recorded_frames(args.recorded).values()]
+    else:
+        frames = synthetic_frames(args.repeat, args.chats, args.messages)
+
+    print(f"{len(frames)} frames, {sum(map(len, frames)) / 1024:.0f} KiB of JSON, link {args.link_kbps:g} kbit/s")
+    print(f"{'level':<6} {'action':<13} {'raw KiB':>9} {'wire KiB':>9} {'ratio':>6} {'cpu ms':>8} {'link s':>8}")
+    for level in LEVELS:
+        # best of a few runs, the first one also pays for warming up
+        runs = [replay(frames, level, args.window_bits) for _ in range(args.runs)]
+        traffic, elapsed = runs[0][0], min(run[1] for run in runs)
+        total = traffic["total"]
+        link = total["wire_in"] * 8 / 1000 / args.link_kbps
+        name = "off" if level is None else str(level)
+        for action in ("get_chats", "get_messages"):
+            if action in traffic:
+                stats = traffic[action]
+                print(f"{name:<6} {action:<13} {stats['raw_in'] / 1024:>9.0f} {stats['wire_in'] / 1024:>9.0f} {stats['ratio_in']:>6.3f}")
+        print(f"{name:<6} {'total':<13} {total['raw_in'] / 1024:>9.0f} {total['wire_in'] / 1024:>9.0f} {total['ratio_in']:>6.3f} {elapsed * 1000:>8.1f} {elapsed + link:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+GUI thread time to take in a page of messages, when ActionHandler built the
+MessageType objects itself against when PayloadDecoder builds them on the
+connection thread and the GUI thread only applies them.
+
+    python -m benchmarks.bench_decode [--messages 1000] [--rounds 50]
+"""
+import argparse
+import json
+import random
+import time
+
+from chat_types import MessageType
+from utils.payload_decoder import PayloadDecoder
+from utils.state import State
+
+
+def synthetic_frame(count: int) -> bytes:
+    random.seed(1)
+    rows = []
+    for i in range(count):
+        sender = random.choice(["user-1", "user-2"])
+        row = {
+            "id": f"m{i}", "text": "lorem ipsum " * random.randint(1, 4), "sender": sender,
+            "time": 1700000000.0 + i, "status": "read", "chat_id": "chat-1", "reply_to": None, "local_id": None,
+        }
+        if rows and random.random() < 0.1:
+            row["reply_to"] = dict(random.choice(rows[-100:]))
+        rows.append(row)
+    frame = {"action": "get_messages", "data": {"chat": {"id": "chat-1"}, "results": rows, "has_more": True}}
+    return json.dumps(frame).encode()
+
+
+def handle_before(state: State, frame: dict):
+    # what ActionHandler.get_messages did, gv.get() going to the session dict
+    def get(key, default=None):
+        return state.session.get(key, default)
+
+    results = frame.get("data", {}).get("results")
+    has_more = frame.get("data", {}).get("has_more")
+    chat_id = frame.get("data", {}).get("chat").get("id")
+    messages = []
+    for message_data in results:
+        if message_data.get("reply_to"):
+            message_data["reply_to"] = MessageType(**message_data["reply_to"], is_mine=message_data["reply_to"]["sender"] == get("user", {}).get("id"))
+        messages.append(MessageType(**message_data, is_mine=message_data["sender"] == get("user", {}).get("id")))
+    state.upsert_messages(chat_id, messages, has_more=bool(has_more))
+
+
+def handle_after(state: State, frame: dict):
+    # what ActionHandler.get_messages does with a decoded frame
+    has_more = frame.get("data", {}).get("has_more")
+    chat_id = frame.get("data", {}).get("chat").get("id")
+    state.upsert_messages(chat_id, frame["decoded"], has_more=bool(has_more))
+
+
+def fresh_state() -> State:
+    state = State()
+    state.session["user"] = {"id": "user-1"}
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+    encoded = synthetic_frame(args.messages)
+    decoder = PayloadDecoder("user-1")
+
+    before = after = decoding = 0.0
+    for _ in range(args.rounds):
+        frame, state = json.loads(encoded), fresh_state()
+        started = time.perf_counter()
+        handle_before(state, frame)
+        before += time.perf_counter() - started
+
+        frame, state = json.loads(encoded), fresh_state()
+        started = time.perf_counter()
+        decoder.decode(frame)
+        decoding += time.perf_counter() - started
+        started = time.perf_counter()
+        handle_after(state, frame)
+        after += time.perf_counter() - started
+
+    print(f"{args.messages} message page, ms per page over {args.rounds} rounds")
+    print(f"{'GUI thread before':<28} {before / args.rounds * 1000:>8.2f}")
+    print(f"{'GUI thread after':<28} {after / args.rounds * 1000:>8.2f}")
+    print(f"{'connection thread decoding':<28} {decoding / args.rounds * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Bytes per message held in memory for a decoded chat history, with the plain
+dataclass messages histories used to hold against the slotted, interned ones
+kept in a MessageCollection and against ColumnarMessageCollection.
+
+    python -m benchmarks.bench_memory [--messages 500000]
+"""
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+from dataclasses import dataclass
+from typing import Optional
+
+from chat_types import MessageType
+from utils.columnar_collection import ColumnarMessageCollection
+from utils.message_collection import MessageCollection
+
+
+@dataclass
+class PlainMessage:
+    """MessageType as it was: a __dict__ per instance and a copy of every replied message"""
+    id: str
+    text: str
+    sender: str
+    time: float
+    status: str = "sending"
+    is_mine: Optional[bool] = False
+    chat_id: Optional[str] = None
+    reply_to: Optional["PlainMessage"] = None
+    local_id: Optional[str] = None
+
+
+def synthetic_rows(count: int) -> bytes:
+    random.seed(1)
+    rows = []
+    for i in range(count):
+        sender = random.choice(["user-1", "user-2"])
+        row = {
+            "id": f"{i:08d}", "text": "lorem ipsum " * random.randint(1, 4), "sender": sender,
+            "time": 1700000000.0 + i, "status": random.choice(["sent", "read"]), "is_mine": sender == "user-1",
+            "chat_id": "chat-1", "reply_to": None, "local_id": None,
+        }
+        if rows and random.random() < 0.1:
+            row["reply_to"] = dict(random.choice(rows[-1000:]))
+        rows.append(row)
+    # decoding gives every message its own sender, chat id and status strings, as loading does
+    return json.dumps(rows).encode()
+
+
+def decode(message_type, rows):
+    messages = []
+    for row in rows:
+        reply_to = row.pop("reply_to")
+        messages.append(message_type(**row, reply_to=message_type(**reply_to) if reply_to else None))
+    return messages
+
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    held = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del held
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500_000)
+    args = parser.parse_args()
+    encoded = synthetic_rows(args.messages)
+
+    before = measure(lambda: decode(PlainMessage, json.loads(encoded)))
+    after = measure(lambda: MessageCollection(decode(MessageType, json.loads(encoded))))
+    columnar = measure(lambda: ColumnarMessageCollection(decode(MessageType, json.loads(encoded))))
+
+    print(f"{args.messages} messages")
+    print(f"{'':<22} {'MiB':>8} {'bytes/message':>14}")
+    print(f"{'plain dataclasses':<22} {before / 2 ** 20:>8.1f} {before / args.messages:>14.0f}")
+    print(f"{'slotted + collection':<22} {after / 2 ** 20:>8.1f} {after / args.messages:>14.0f}")
+    print(f"{'columnar':<22} {columnar / 2 ** 20:>8.1f} {columnar / args.messages:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
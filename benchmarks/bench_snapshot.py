@@ -0,0 +1,64 @@
+"""
+Compare the JSON snapshot written by the journal engine with the binary one.
+
+    python -m benchmarks.bench_snapshot [--chats 50] [--messages 2000]
+"""
+import argparse
+import json
+import random
+import time
+
+from lib import binary_snapshot
+
+
+def synthetic_snapshot(chats: int, messages: int) -> dict:
+    random.seed(1)
+    snapshot = {"sidebar_opened": False, "user": {"id": "me", "username": "me"}}
+    snapshot["chats"] = [
+        {"id": f"chat-{c}", "last_message": "hi", "updated_at": 1700000000.0,
+         "user": {"id": f"user-{c}", "username": f"user{c}", "email": "", "last_seen": 0.0}}
+        for c in range(chats)
+    ]
+    for c in range(chats):
+        rows = []
+        for m in range(messages):
+            sender = random.choice(["me", f"user-{c}"])
+            row = {
+                "id": f"{c:04d}-{m:08d}", "text": "lorem ipsum " * random.randint(1, 8), "sender": sender,
+                "time": 1700000000.0 + m, "status": random.choice(["sent", "read"]), "is_mine": sender == "me",
+                "chat_id": f"chat-{c}", "reply_to": None, "local_id": None,
+            }
+            if rows and random.random() < 0.1:
+                row["reply_to"] = dict(random.choice(rows))
+            rows.append(row)
+        snapshot[f"chat_messages_chat-{c}"] = {"messages": rows, "has_more": True}
+    return snapshot
+
+
+def measure(fn, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    snapshot = synthetic_snapshot(args.chats, args.messages)
+    json_data = json.dumps(snapshot).encode()
+    binary_data = binary_snapshot.dumps(snapshot)
+
+    print(f"{args.chats} chats x {args.messages} messages")
+    print(f"{'format':<8} {'size KiB':>10} {'save ms':>10} {'load ms':>10}")
+    print(f"{'json':<8} {len(json_data) / 1024:>10.0f} {measure(lambda: json.dumps(snapshot).encode()):>10.1f} {measure(lambda: json.loads(json_data)):>10.1f}")
+    print(f"{'binary':<8} {len(binary_data) / 1024:>10.0f} {measure(lambda: binary_snapshot.dumps(snapshot)):>10.1f} {measure(lambda: binary_snapshot.loads(binary_data)):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
+import sys
 from dataclasses import dataclass
 from typing import Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class MessageType:
     id: str
     text: str
@@ -16,8 +17,28 @@ class MessageType:
 
     local_id: Optional[str] = None
 
+    def __post_init__(self):
+        # the same few senders, chats and statuses repeat across every message
+        if isinstance(self.sender, str):
+            self.sender = sys.intern(self.sender)
+        if isinstance(self.chat_id, str):
+            self.chat_id = sys.intern(self.chat_id)
+        if isinstance(self.status, str):
+            self.status = sys.intern(self.status)
 
-@dataclass
+    def to_dict(self) -> dict:
+        """Like asdict(), but a reply is stored without the message it replied to in turn"""
+        # one level only, replies are shared objects and their chains can be long
+        return self._fields(self.reply_to._fields(None) if self.reply_to else None)
+
+    def _fields(self, reply_to: Optional[dict]) -> dict:
+        return {
+            "id": self.id, "text": self.text, "sender": self.sender, "time": self.time, "status": self.status,
+            "is_mine": self.is_mine, "chat_id": self.chat_id, "reply_to": reply_to, "local_id": self.local_id,
+        }
+
+
+@dataclass(slots=True)
 class StatType:
     photos: Optional[int]
     videos: Optional[int]
@@ -26,7 +47,7 @@ class StatType:
     voices: Optional[int]
 
 
-@dataclass
+@dataclass(slots=True)
 class UserType:
     username: str
     email: str
@@ -38,7 +59,7 @@ class UserType:
     is_online: bool = False
 
 
-@dataclass
+@dataclass(slots=True)
 class ChatType:
     id: str
     last_message: str
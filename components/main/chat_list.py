@@ -17,6 +17,8 @@ class ChatList(QtWidgets.QWidget):
         super().__init__()
         self.active_item = None
         gv.signal_manager.chats_changed.connect(self.load_chats)
+        gv.signal_manager.chat_changed.connect(self.update_chat)
+        gv.signal_manager.chat_moved.connect(self.move_chat)
         gv.signal_manager.selected_chat_changed.connect(lambda chat: self.set_active_item_by_id(chat.id))
 
         self.setMinimumWidth(250)
@@ -66,15 +68,18 @@ class ChatList(QtWidgets.QWidget):
 
         # Sidebar items
         self.chat_items = []
+        self.items_by_id = {}
         self.result_items = []
 
     def load_chats(self, chats: List[ChatType]):
         self.clear_chat_layout()
         self.chat_items = []
+        self.items_by_id = {}
         for chat in chats:
             item = ChatListItem(chat)
             item.clicked.connect(lambda item: self.handle_item_click(chat_item=item))
             self.chat_items.append(item)
+            self.items_by_id[chat.id] = item
             if gv.get("selected_chat") and item.chat.id == gv.get("selected_chat").id:
                 self.set_active_item(item)
             self.chats_layout.addWidget(self.chat_items[-1])
@@ -93,10 +98,26 @@ class ChatList(QtWidgets.QWidget):
 
 
     def set_active_item_by_id(self, chat_id):
-        for item in self.chat_items:
-            if item.chat.id == chat_id:
-                self.set_active_item(item)
-                break
+        item = self.items_by_id.get(chat_id)
+        if item:
+            self.set_active_item(item)
+
+    def update_chat(self, chat: ChatType):
+        item = self.items_by_id.get(chat.id)
+        if item:
+            item.update_chat(chat)
+
+    def move_chat(self, chat_id: str, before: int, after: int):
+        """Move one item to where its chat moved in the recency order, the rest stay put"""
+        item = self.items_by_id.get(chat_id)
+        if item is None or before >= len(self.chat_items) or self.chat_items[before] is not item:
+            self.load_chats(gv.state.chats)
+            return
+        self.chat_items.insert(after, self.chat_items.pop(before))
+        # while search results are shown the layout doesn't hold the chat items
+        if self.chats_layout.indexOf(item) != -1:
+            self.chats_layout.removeWidget(item)
+            self.chats_layout.insertWidget(after, item)
 
     def set_active_item(self, active_item):
         if self.active_item:
@@ -130,7 +151,8 @@ class ChatList(QtWidgets.QWidget):
                 widget.setParent(None)
 
     def request_load_chat(self, result_item = None, chat_item = None):
-        gv.send_data({"action": "get_messages", "data": {"user_id": result_item.id if result_item else None, "chat_id": chat_item.id if chat_item else None}})
+        # a request of its own, so its answer can't complete a ChatBox's page request
+        gv.request("get_messages", {"user_id": result_item.id if result_item else None, "chat_id": chat_item.id if chat_item else None})
 
     def load_search_results(self, results: List[UserType]):
         self.clear_chat_layout()
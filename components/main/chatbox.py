@@ -9,13 +9,14 @@ from PySide6.QtCore import QSize, Qt, QTimer, Signal
 from PySide6.QtGui import QTextCursor
 from PySide6.QtWidgets import QHBoxLayout
 
-from chat_types import ChatType, MessageType
+from chat_types import ChatType, MessageType, UserType
 from components.ui.message import Message
 from components.ui.rounded_avatar import RoundedAvatar
 from components.ui.text_edit import TextEdit
 from components.ui.typing_indicator import TypingIndicator
 from styles import Colors, replying_to_label_style
 from utils import gv
+from utils.message_collection import MessageCollection
 from utils.time import format_timestamp
 
 
@@ -34,11 +35,17 @@ class ChatBox(QtWidgets.QWidget):
         self.edit_opened = False
         self.message_to_edit = None
         self.has_more = False
+        # get_messages waiting for its page, a newer chat or scroll makes it stale
+        self.page_request = None
         self.current_messages: dict = {}
+        # messages behind the widgets in layout order, layout index = position + 1
+        self.shown = MessageCollection()
         self.setContentsMargins(0, 0, 0, 0)
 
-        gv.signal_manager.messages_changed.connect(self.on_messages_change)
+        self.channel = None
+        self.connect_channel(self.chat.id)
         gv.signal_manager.sidebar_opened_changed.connect(self.on_sidebar_change)
+        gv.signal_manager.user_changed.connect(self.on_user_change)
 
         self.setStyleSheet("""
             QWidget { background-color: #262624; color: #ffffff; }
@@ -215,12 +222,23 @@ class ChatBox(QtWidgets.QWidget):
         self.main_layout.addLayout(self.input_part)
 
         if not gv.get(f"chat_messages_{chat.id}"):
-            data = {"action": "get_messages", "data": {"chat_id": self.chat.id}}
-            gv.send_data(data)
+            self.page_request = gv.request("get_messages", {"chat_id": self.chat.id})
         else:
             self.load_messages(gv.get(f"chat_messages_{chat.id}", []))
             QTimer.singleShot(100, self.scroll_to_bottom)
 
+    def on_user_change(self, user: UserType):
+        if user.id != self.chat.user.id:
+            return
+        self.chat.user.is_online = user.is_online
+        self.chat.user.last_seen = user.last_seen
+        if user.is_online:
+            self.last_seen.setText("online")
+            self.last_seen.setStyleSheet(f"color: {Colors.PRIMARY}; font-size: 14px")
+        else:
+            self.last_seen.setText(format_timestamp(user.last_seen))
+            self.last_seen.setStyleSheet("color: grey; font-size: 14px")
+
     def on_sidebar_change(self, state):
         print("changedd", state)
         self.sidebar_toggled = state
@@ -230,66 +248,96 @@ class ChatBox(QtWidgets.QWidget):
             else qta.icon("msc.layout-sidebar-right-off", color="white")
         )
 
-    def on_messages_change(self, messages: dict, chat_id: str):
-        if not messages:
+    def connect_channel(self, chat_id: str):
+        """Receive message updates of `chat_id` only"""
+        if self.channel is not None:
+            # the old chat's channel may live on for other holders, stop hearing it first
+            for signal, slot in self._channel_slots():
+                signal.disconnect(slot)
+            self.destroyed.disconnect(self.channel.release)
+            self.channel.release()
+        self.channel = gv.chat_channel(chat_id, self)
+        for signal, slot in self._channel_slots():
+            signal.connect(slot)
+
+    def _channel_slots(self):
+        return [
+            (self.channel.messages_changed, self.on_messages_change),
+            (self.channel.message_added, self.on_message_added),
+            (self.channel.message_updated, self.on_message_updated),
+            (self.channel.message_removed, self.on_message_removed),
+            (self.channel.messages_prepended, self.on_messages_prepended),
+            (self.channel.has_more_changed, self.on_has_more_change),
+        ]
+
+    def on_messages_change(self, messages: dict):
+        # the whole history was replaced, render it again
+        if messages:
+            self.load_messages(messages)
+
+    def on_message_added(self, message: MessageType):
+        if message.id in self.current_messages:
+            self.on_message_updated(message.id, message)
             return
 
-        if chat_id != self.chat.id:
+        self.shown.add(message)
+        if self.shown.last is message:
+            # new message
+            self.current_messages[message.id] = self.add_new_message(message)
+        else:
+            self.current_messages[message.id] = self.add_new_message(message, index=self.shown.index(message.id) + 1)
+
+    def on_message_updated(self, previous_id: str, message: MessageType):
+        if previous_id not in self.current_messages:
+            return
+        message_widget = self.current_messages.pop(previous_id)
+        if previous_id != message.id:
+            self.shown.rename(previous_id, message.id)
+        if message_widget.message != message.text: # text edited
+            message_widget.set_text(message.text)
+        elif message_widget.status != message.status: # status changed, message read
+            message_widget.set_status(message.status)
+        # delete, edit and reply use the widget's message, it has to carry the current id
+        self.shown.add(message)
+        message_widget.message_type = message
+        self.current_messages[message.id] = message_widget
+
+    def on_message_removed(self, message_id: str):
+        if message_id not in self.current_messages:
+            return
+        self.shown.remove(message_id)
+        message_widget = self.current_messages.pop(message_id)
+        # take it out of the layout now so layout indexes match self.shown
+        self.messages_container.removeWidget(message_widget)
+        message_widget.deleteLater()
+
+    def on_messages_prepended(self, messages: list):
+        messages = [message for message in messages if message.id not in self.current_messages]
+        if not messages:
             return
 
-        self.has_more = messages.get("has_more", False)
-        for message in messages.get('messages', []):
-            # message new added:
-            if message.id not in self.current_messages.keys():
-
-                if message.local_id and message.local_id in self.current_messages.keys():
-                    # message already exists at chatbox, but with different id.
-                    message_widget = self.current_messages[message.local_id]
-                    if message_widget.message != message.text: # text edited
-                        message_widget.set_text(message.text)
-                    elif message_widget.status != message.status: # status changed, message read
-                        message_widget.set_status(message.status)
-                    self.current_messages[message.id] = message_widget
-                    self.current_messages.pop(message.local_id)
-
-                # first check if message is new or older:
-                elif self.messages_container.count() == 1 or self.messages_container.itemAt(self.messages_container.count() - 1).widget().message_type.time < message.time:
-                    # new message
-                    self.current_messages[message.id] = self.add_new_message(message)
-                elif self.messages_container.itemAt(1).widget().message_type.time > message.time:
-                    # older message than first message
-                    self.current_messages[message.id] = self.add_new_message(message, index=1)
-                else:
-                    # finally try to find by comparing messages by one
-                    found_place = False
-                    for i in range(1, self.messages_container.count()):
-                        item = self.messages_container.itemAt(i).widget()
-                        next_item = self.messages_container.itemAt(i+1).widget() if i != self.messages_container.count() - 1 else None
-                        if message.time > item.message_type.time and (next_item is None or message.time < next_item.message_type.time):
-                            # reach to last message or found place where current item is older from message_to_add and next item is newer thab message_to_add
-                            found_place = i + 1
-                            break
-                    if found_place:
-                        self.current_messages[message.id] = self.add_new_message(message, index=found_place)
-
-            # message exists but changed, text edited or status marked as read
+        first_widget = self.messages_container.itemAt(1).widget() if self.messages_container.count() > 1 else None
+        self.shown.prepend(messages)
+        unread_messages = []
+        for index, message in enumerate(messages):
+            next = message.sender == messages[index - 1].sender if index != 0 else None
+            if index < len(messages) - 1:
+                previous = message.sender == messages[index + 1].sender
             else:
-                message_widget = self.current_messages[message.id]
-                if message_widget.message != message.text: # text edited
-                    message_widget.set_text(message.text)
-                elif message_widget.status != message.status: # status changed, message read
-                    message_widget.set_status(message.status)
-
-        # check for deleted messages
-        existing_message_ids = [message.id for message in messages.get('messages', [])]
-        keys_to_pop = []
-        for message_id in self.current_messages.keys():
-            if message_id not in existing_message_ids:
-                item_to_delete = self.current_messages[message_id]
-                item_to_delete.deleteLater()
-                keys_to_pop.append(message_id)
-        for key in keys_to_pop:
-            self.current_messages.pop(key)
+                previous = first_widget is not None and message.sender == first_widget.message_type.sender
+            self.current_messages[message.id] = self.add_message(message, previous, next, index=index + 1)
+
+            if not self.check_message_is_mine(message) and message.status != "read":
+                unread_messages.append(message.id)
+        if first_widget is not None:
+            first_widget.update_previous_next(next=first_widget.message_type.sender == messages[-1].sender)
+
+        if unread_messages:
+            data = {'action': 'read_message', "data": {"message_ids": unread_messages, "chat_id": self.chat.id}}
+            gv.send_data(data)
+
+    def on_has_more_change(self, has_more: bool):
+        self.has_more = has_more
 
     def adjust_input_height(self):
         doc_height = self.chat_input.document().size().height()
@@ -342,56 +390,41 @@ class ChatBox(QtWidgets.QWidget):
 
     def send_my_message(self):
         text = self.chat_input.toPlainText()
-        if text.strip():
-            data = None
-            if self.message_to_edit:
-                data = {
-                    "action": "edit_message",
-                    "data": {
-                        "message_id": self.message_to_edit.id,
-                        "text": text
-                    }
+        if not text.strip():
+            return
+        if self.message_to_edit:
+            data = {
+                "action": "edit_message",
+                "data": {
+                    "message_id": self.message_to_edit.id,
+                    "text": text
                 }
-                self.chat_input.setText("")
-                self.close_edit()
-            else:
-                if gv.get("selected_chat"):
-                    data = {
-                        "action": "new_message",
-                        "data": {
-                            "text": text,
-                            "chat_id": gv.get("selected_chat", "").id,
-                            "reply_to": self.reply_to_message.id if self.reply_to_message else None
-                        }
-                    }
-                    self.chat_input.setText("")
-                    self.close_reply()
-                else:
-                    print("No chat selected")
-
-            if gv.get("is_authenticated"):
-                if data:
-                    gv.send_data(data)
-            else:
-                local_id = str(random.randint(999999999999, 10000000000000))
-                message = MessageType(
-                    id=local_id,
-                    local_id=local_id,
-                    text=text,
-                    sender=gv.get("user", {}).get("id"),
-                    time=datetime.now().timestamp(),
-                    status="sending",
-                    chat_id=gv.get("selected_chat", "").id,
-                    reply_to=self.reply_to_message
-                )
-
-                waiting_messages = gv.get("waiting_messages", [])
-                waiting_messages.append(message)
-                gv.set("waiting_messages", waiting_messages)
-
-                messages = gv.get(f"chat_messages_{gv.get('selected_chat').id}", {})
-                messages.get("messages", []).append(message)
-                gv.set(f"chat_messages_{gv.get('selected_chat').id}", messages)
+            }
+            self.chat_input.setText("")
+            self.close_edit()
+            gv.send_data(data)
+        elif gv.get("selected_chat"):
+            local_id = str(random.randint(999999999999, 10000000000000))
+            message = MessageType(
+                id=local_id,
+                local_id=local_id,
+                text=text,
+                sender=gv.get("user", {}).get("id"),
+                time=datetime.now().timestamp(),
+                status="sending",
+                is_mine=True,
+                chat_id=gv.get("selected_chat", "").id,
+                reply_to=self.reply_to_message
+            )
+            self.chat_input.setText("")
+            self.close_reply()
+
+            # shown right away, the outbox sends it (now or once connected) until the server confirms it
+            with gv.batch():
+                gv.state.add_to_outbox(message)
+                gv.state.upsert_messages(message.chat_id, [message])
+        else:
+            print("No chat selected")
 
     def check_message_is_mine(self, message: MessageType):
         return message.is_mine
@@ -400,6 +433,7 @@ class ChatBox(QtWidgets.QWidget):
         self.current_messages = {}
 
         messages = data.get("messages", [])
+        self.shown = MessageCollection(messages)
         self.has_more = data.get("has_more")
         while self.messages_container.count() > 1:
             item = self.messages_container.takeAt(1)
@@ -436,10 +470,13 @@ class ChatBox(QtWidgets.QWidget):
         # self.chat = chat
         self.chat_input.setFocus(Qt.FocusReason.MouseFocusReason)
 
+        if chat.id != self.chat.id:
+            self.connect_channel(chat.id)
+            if self.page_request is not None:
+                self.page_request.cancel()
         self.chat = deepcopy(chat)
         if not gv.get(f"chat_messages_{chat.id}"):
-            data = {"action": "get_messages", "data": {"chat_id": self.chat.id}}
-            gv.send_data(data)
+            self.page_request = gv.request("get_messages", {"chat_id": self.chat.id})
         else:
             self.load_messages(gv.get(f"chat_messages_{chat.id}", []))
             QTimer.singleShot(100, self.scroll_to_bottom)
@@ -507,8 +544,13 @@ class ChatBox(QtWidgets.QWidget):
 
     def on_scroll(self, value):
         if value == self.scroll_area.verticalScrollBar().minimum():
-            if self.has_more:
+            if self.has_more and (self.page_request is None or self.page_request.done()):
                 # load more messages:
                 first_message = self.messages_container.itemAt(1).widget() # because 1st is QSpacer
-                data = {"action": "get_messages", "data": {"chat_id": gv.get("selected_chat", "").id, "last_message": first_message.message_type.id}}
-                gv.send_data(data)
+                older_messages = gv.load_older_messages(self.chat.id, first_message.message_type.time)
+                if older_messages:
+                    # page from the local store first, server is asked once it runs out
+                    gv.state.upsert_messages(self.chat.id, older_messages, persist=False)
+                    return
+
+                self.page_request = gv.request("get_messages", {"chat_id": self.chat.id, "last_message": first_message.message_type.id})
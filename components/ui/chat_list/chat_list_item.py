@@ -79,6 +79,13 @@ class ChatListItem(QtWidgets.QWidget):
 
         self.main_layout.addLayout(self.name_part)
 
+    def update_chat(self, chat):
+        """Show a new last message or time without rebuilding the item"""
+        self.chat = chat
+        self.name_label.setText(chat.user.display_name)
+        self.time_label.setText(format_timestamp(chat.updated_at))
+        self.last_message_label.setText(chat.last_message)
+
     def update_background(self, color, active=False):
         """Update the background color using palette"""
         if active:
@@ -7,3 +7,24 @@ load_dotenv()
 HOST = os.getenv("HOST", "")
 PORT = os.getenv("PORT")
 IMAGE_HOST = os.getenv("IMAGE_HOST")
+STORAGE_ENGINE = os.getenv("STORAGE_ENGINE", "journal")  # "journal", "sqlite" or "shards"
+PERSIST_INTERVAL_MS = int(os.getenv("PERSIST_INTERVAL_MS", "250"))
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "100"))
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT", "json")  # "json" or "binary", used by the journal engine
+MESSAGE_CACHE_BUDGET = int(os.getenv("MESSAGE_CACHE_BUDGET", "20000"))  # messages kept in memory across all chats
+CHAT_MESSAGE_CAP = int(os.getenv("CHAT_MESSAGE_CAP", "2000"))  # messages kept in memory per chat
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "objects")  # "objects" or "columnar" for very large chats
+COALESCE_UPDATES = os.getenv("COALESCE_UPDATES", "1") == "1"  # one change event per event loop iteration
+INBOUND_FRAME_BUDGET_MS = float(os.getenv("INBOUND_FRAME_BUDGET_MS", "8"))  # time spent handling frames per event loop iteration
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto")  # "auto", "orjson", "ujson" or "json"
+READ_RECEIPT_WINDOW_MS = float(os.getenv("READ_RECEIPT_WINDOW_MS", "50"))  # read receipts of a chat sent within it go out as one frame
+RECONNECT_BASE_MS = float(os.getenv("RECONNECT_BASE_MS", "500"))  # second retry after a disconnect, doubling from there
+RECONNECT_MAX_MS = float(os.getenv("RECONNECT_MAX_MS", "30000"))
+OUTBOX_MAX_IN_FLIGHT = int(os.getenv("OUTBOX_MAX_IN_FLIGHT", "32"))  # unconfirmed messages sent at once, across chats (one per chat)
+OUTBOX_ACK_TIMEOUT_MS = float(os.getenv("OUTBOX_ACK_TIMEOUT_MS", "10000"))  # resend a message the server hasn't confirmed by then
+WS_COMPRESSION = os.getenv("WS_COMPRESSION", "deflate")  # "deflate" or "off"
+WS_DEFLATE_LEVEL = int(os.getenv("WS_DEFLATE_LEVEL", "6"))  # zlib level of sent frames, 1 fastest to 9 smallest
+WS_DEFLATE_WINDOW_BITS = int(os.getenv("WS_DEFLATE_WINDOW_BITS", "0"))  # 9-15 caps the server's window, 0 lets it choose
+OUTBOUND_BACKGROUND_LIMIT = int(os.getenv("OUTBOUND_BACKGROUND_LIMIT", "256"))  # queued sync/receipt frames before send() makes producers wait
+OPEN_CHATBOXES = int(os.getenv("OPEN_CHATBOXES", "8"))  # chats kept rendered for quick switching, older ones are rebuilt when reopened
+LOG_FRAMES = os.getenv("LOG_FRAMES", "0") == "1"  # print every received frame, slow with large payloads
@@ -0,0 +1,129 @@
+import mmap
+import os
+import struct
+from bisect import bisect_left, insort
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from lib import codec
+
+# time f64 | offset u64 | length u32 | id length u16, followed by the id
+_entry = struct.Struct("<dQIH")
+
+
+class MessageArchive:
+    """
+    Append-only file of old messages of one chat, read through mmap.
+
+    `chat_<id>.arc` holds the encoded messages back to back and the sidecar
+    `chat_<id>.idx` maps (time, message id) to the byte range of a message. The
+    index is an append-only log too: a newer entry for an id supersedes the
+    older one and an entry with length 0 deletes it.
+    """
+
+    def __init__(self, directory: str, chat_id: str):
+        os.makedirs(directory, exist_ok=True)
+        self.archive_file = os.path.join(directory, f"chat_{chat_id}.arc")
+        self.index_file = os.path.join(directory, f"chat_{chat_id}.idx")
+
+        self._lock = Lock()
+        self._entries: Dict[str, Tuple[float, int, int]] = {}
+        self._order: List[Tuple[float, str]] = []
+        self._map: Optional[mmap.mmap] = None
+        self._mapped_size = 0
+        self._load_index()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, message_id):
+        return message_id in self._entries
+
+    def append(self, messages: Iterable[dict]):
+        with self._lock:
+            size = os.path.getsize(self.archive_file) if os.path.exists(self.archive_file) else 0
+            records = []
+            entries = []
+            for message in messages:
+                encoded = codec.dumps(message)
+                entry = self._entries.get(message["id"])
+                if entry and entry[2] == len(encoded):
+                    with self._view(entry[1], entry[2]) as view:
+                        if view == encoded:
+                            continue
+                records.append(encoded)
+                entries.append((message.get("time") or 0.0, size, len(encoded), message["id"]))
+                size += len(encoded)
+
+            if not records:
+                return
+            with open(self.archive_file, "ab") as f:
+                f.write(b"".join(records))
+            self._write_entries(entries)
+
+    def remove(self, ids: Iterable[str]):
+        with self._lock:
+            entries = [(self._entries[message_id][0], 0, 0, message_id) for message_id in ids if message_id in self._entries]
+            if entries:
+                self._write_entries(entries)
+
+    def page_before(self, before: Optional[float], limit: int) -> List[dict]:
+        """Up to `limit` newest messages older than `before`, oldest first"""
+        with self._lock:
+            end = len(self._order) if before is None else bisect_left(self._order, (before, ""))
+            page = self._order[max(end - limit, 0):end]
+            messages = []
+            for _, message_id in page:
+                with self._view(*self._entries[message_id][1:]) as view:
+                    # slicing the map doesn't copy, only the page being decoded is read
+                    messages.append(codec.loads(view))
+            return messages
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+                self._mapped_size = 0
+
+    def _view(self, offset: int, length: int) -> memoryview:
+        if offset + length > self._mapped_size:
+            # the file grew since it was mapped
+            if self._map is not None:
+                self._map.close()
+            with open(self.archive_file, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped_size = len(self._map)
+        return memoryview(self._map)[offset:offset + length]
+
+    def _write_entries(self, entries: List[Tuple[float, int, int, str]]):
+        with open(self.index_file, "ab") as f:
+            for time, offset, length, message_id in entries:
+                encoded_id = message_id.encode()
+                f.write(_entry.pack(time, offset, length, len(encoded_id)) + encoded_id)
+                self._apply(time, offset, length, message_id)
+
+    def _apply(self, time: float, offset: int, length: int, message_id: str):
+        previous = self._entries.pop(message_id, None)
+        if previous:
+            index = bisect_left(self._order, (previous[0], message_id))
+            del self._order[index]
+        if length:
+            self._entries[message_id] = (time, offset, length)
+            insort(self._order, (time, message_id))
+
+    def _load_index(self):
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file, "rb") as f:
+            content = f.read()
+
+        offset = 0
+        while offset + _entry.size <= len(content):
+            time, record_offset, length, id_length = _entry.unpack_from(content, offset)
+            offset += _entry.size
+            if offset + id_length > len(content):
+                # torn write at the end of the index
+                break
+            self._apply(time, record_offset, length, content[offset:offset + id_length].decode())
+            offset += id_length
@@ -0,0 +1,26 @@
+import random
+from typing import Optional
+
+
+class Backoff:
+    """
+    Delays between reconnect attempts: the first retry is immediate, then
+    `base` doubling up to `cap`, each drawn from [delay / 2, delay] so many
+    clients dropped by the same outage don't come back in lockstep.
+    """
+
+    def __init__(self, base: float = 0.5, cap: float = 30.0, rng: Optional[random.Random] = None):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+        self._rng = rng or random.Random()
+
+    def next_delay(self) -> float:
+        attempt, self.attempts = self.attempts, self.attempts + 1
+        if attempt == 0:
+            return 0.0
+        delay = min(self.cap, self.base * 2 ** min(attempt - 1, 32))
+        return self._rng.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.attempts = 0
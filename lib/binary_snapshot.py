@@ -0,0 +1,255 @@
+"""
+Compact binary form of the persisted gv snapshot.
+
+Layout (little endian):
+
+    magic "VEIA" | version u16
+    string table:  count u32, then (len u32, utf-8 bytes) per string
+    other keys:    len u32, JSON of every key that isn't chat history
+    chats:         count u32, then per chat
+                       chat_id string index u32 | has_more u8 | count u32
+                       count * (len u32, message record)
+
+A message record is the fixed header `time f64 | status u8 | is_mine u8 |
+flags u8 | sender string index u32 | id length u16 | text length u32` followed
+by the id and text, and optionally the reply id, local id and chat id (left out
+when it is the id of the chat the record belongs to). Sender and chat ids go
+through the string table. Replies are stored as the id of the replied message
+and resolved against the same chat on load; only replies to messages missing
+from the chat are embedded as a nested record.
+"""
+import struct
+from typing import Dict, List, Optional
+
+from lib import codec
+
+MAGIC = b"VEIA"
+VERSION = 1
+
+STATUSES = ["sending", "sent", "read", "delivered"]
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+STATUS_INLINE = 255
+
+FLAG_REPLY_ID = 1
+FLAG_REPLY_EMBEDDED = 2
+FLAG_LOCAL_ID = 4
+FLAG_CHAT_ID = 8
+FLAG_STATUS_INLINE = 16
+FLAG_NO_SENDER = 32
+FLAG_SAME_CHAT_ID = 64
+FLAG_OPTIONAL = FLAG_REPLY_ID | FLAG_REPLY_EMBEDDED | FLAG_LOCAL_ID | FLAG_CHAT_ID
+
+_header = struct.Struct("<4sH")
+_u16 = struct.Struct("<H")
+_u32 = struct.Struct("<I")
+_chat = struct.Struct("<IBI")
+_record = struct.Struct("<dBBBIHI")
+
+
+class SnapshotFormatError(Exception):
+    pass
+
+
+def is_binary(data: bytes) -> bool:
+    return data[:4] == MAGIC
+
+
+def dumps(snapshot: dict) -> bytes:
+    strings: List[str] = []
+    string_ids: Dict[str, int] = {}
+
+    def intern(value: str) -> int:
+        index = string_ids.get(value)
+        if index is None:
+            index = string_ids[value] = len(strings)
+            strings.append(value)
+        return index
+
+    chats = []
+    other = {}
+    for key, value in snapshot.items():
+        if key.startswith("chat_messages_") and isinstance(value, dict) and "messages" in value:
+            chat_id = key.split("chat_messages_")[1]
+            chats.append(_encode_chat(chat_id, value, intern))
+        else:
+            other[key] = value
+
+    parts = [_header.pack(MAGIC, VERSION), _u32.pack(len(strings))]
+    for value in strings:
+        encoded = value.encode()
+        parts.append(_u32.pack(len(encoded)))
+        parts.append(encoded)
+
+    other_encoded = codec.dumps(other)
+    parts.append(_u32.pack(len(other_encoded)))
+    parts.append(other_encoded)
+
+    parts.append(_u32.pack(len(chats)))
+    parts.extend(chats)
+    return b"".join(parts)
+
+
+def loads(data: bytes) -> dict:
+    view = memoryview(data)
+    magic, version = _header.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise SnapshotFormatError("not a binary snapshot")
+    if version != VERSION:
+        raise SnapshotFormatError(f"unsupported snapshot version {version}")
+    offset = _header.size
+
+    (count,) = _u32.unpack_from(view, offset)
+    offset += 4
+    strings = []
+    for _ in range(count):
+        (length,) = _u32.unpack_from(view, offset)
+        offset += 4
+        strings.append(str(view[offset:offset + length], "utf-8"))
+        offset += length
+
+    (length,) = _u32.unpack_from(view, offset)
+    offset += 4
+    snapshot = codec.loads(view[offset:offset + length])
+    offset += length
+
+    (count,) = _u32.unpack_from(view, offset)
+    offset += 4
+    for _ in range(count):
+        chat_index, has_more, message_count = _chat.unpack_from(view, offset)
+        offset += _chat.size
+        chat_id = strings[chat_index]
+
+        messages = []
+        by_id = {}
+        reply_ids = []
+        for _ in range(message_count):
+            (length,) = _u32.unpack_from(view, offset)
+            offset += 4
+            message, reply_id = _decode_record(view, offset, strings, chat_id)
+            offset += length
+            messages.append(message)
+            by_id[message["id"]] = message
+            if reply_id is not None:
+                reply_ids.append((message, reply_id))
+
+        for message, reply_id in reply_ids:
+            reply_to = by_id.get(reply_id)
+            message["reply_to"] = dict(reply_to, reply_to=None) if reply_to else None
+
+        snapshot[f"chat_messages_{chat_id}"] = {"messages": messages, "has_more": bool(has_more)}
+    return snapshot
+
+
+def _encode_chat(chat_id: str, value: dict, intern) -> bytes:
+    messages = value.get("messages", [])
+    known_ids = {message.get("id") for message in messages}
+    parts = [_chat.pack(intern(chat_id), int(bool(value.get("has_more"))), len(messages))]
+    for message in messages:
+        record = _encode_record(message, known_ids, intern, chat_id)
+        parts.append(_u32.pack(len(record)))
+        parts.append(record)
+    return b"".join(parts)
+
+
+def _encode_record(message: dict, known_ids, intern, chat_id: Optional[str] = None) -> bytes:
+    flags = 0
+    tail = []
+
+    status = message.get("status") or "sending"
+    status_code = STATUS_CODES.get(status)
+    if status_code is None:
+        status_code = STATUS_INLINE
+        flags |= FLAG_STATUS_INLINE
+    sender = message.get("sender")
+    if sender is None:
+        flags |= FLAG_NO_SENDER
+
+    reply_to = message.get("reply_to")
+    if reply_to:
+        if reply_to.get("id") in known_ids:
+            flags |= FLAG_REPLY_ID
+            tail.append(_short_string(reply_to["id"]))
+        else:
+            flags |= FLAG_REPLY_EMBEDDED
+            embedded = _encode_record(reply_to, (), intern)
+            tail.append(_u32.pack(len(embedded)))
+            tail.append(embedded)
+    if message.get("local_id"):
+        flags |= FLAG_LOCAL_ID
+        tail.append(_short_string(message["local_id"]))
+    if message.get("chat_id") is not None and message["chat_id"] == chat_id:
+        flags |= FLAG_SAME_CHAT_ID
+    elif message.get("chat_id") is not None:
+        flags |= FLAG_CHAT_ID
+        tail.append(_u32.pack(intern(message["chat_id"])))
+    if flags & FLAG_STATUS_INLINE:
+        tail.append(_short_string(status))
+
+    message_id = (message.get("id") or "").encode()
+    text = (message.get("text") or "").encode()
+    return b"".join([
+        _record.pack(
+            message.get("time") or 0.0, status_code, int(bool(message.get("is_mine"))), flags,
+            intern(sender) if sender is not None else 0, len(message_id), len(text),
+        ),
+        message_id,
+        text,
+        *tail,
+    ])
+
+
+def _decode_record(view: memoryview, offset: int, strings: List[str], chat_id: Optional[str] = None):
+    time, status_code, is_mine, flags, sender_index, id_length, text_length = _record.unpack_from(view, offset)
+    offset += _record.size
+    message_id = str(view[offset:offset + id_length], "utf-8")
+    offset += id_length
+    text = str(view[offset:offset + text_length], "utf-8")
+    offset += text_length
+
+    reply_id = None
+    reply_to = None
+    local_id = None
+    if flags & FLAG_OPTIONAL:
+        if flags & FLAG_REPLY_ID:
+            reply_id, offset = _read_short_string(view, offset)
+        elif flags & FLAG_REPLY_EMBEDDED:
+            (length,) = _u32.unpack_from(view, offset)
+            offset += 4
+            reply_to, _ = _decode_record(view, offset, strings)
+            offset += length
+        if flags & FLAG_LOCAL_ID:
+            local_id, offset = _read_short_string(view, offset)
+        if flags & FLAG_CHAT_ID:
+            (chat_index,) = _u32.unpack_from(view, offset)
+            offset += 4
+            chat_id = strings[chat_index]
+    if not flags & (FLAG_CHAT_ID | FLAG_SAME_CHAT_ID):
+        chat_id = None
+    if flags & FLAG_STATUS_INLINE:
+        status, offset = _read_short_string(view, offset)
+    else:
+        status = STATUSES[status_code]
+
+    message = {
+        "id": message_id,
+        "text": text,
+        "sender": None if flags & FLAG_NO_SENDER else strings[sender_index],
+        "time": time,
+        "status": status,
+        "is_mine": bool(is_mine),
+        "chat_id": chat_id,
+        "reply_to": reply_to,
+        "local_id": local_id,
+    }
+    return message, reply_id
+
+
+def _short_string(value: str) -> bytes:
+    encoded = value.encode()
+    return _u16.pack(len(encoded)) + encoded
+
+
+def _read_short_string(view: memoryview, offset: int):
+    (length,) = _u16.unpack_from(view, offset)
+    offset += 2
+    return str(view[offset:offset + length], "utf-8"), offset + length
@@ -0,0 +1,56 @@
+"""
+JSON encoding for the wire and for local storage, through the fastest
+library that is installed: orjson, then ujson, then the standard library.
+
+`dumps()` returns UTF-8 bytes and `loads()` takes bytes or str, so frames and
+files don't have to go through str on the way.
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+BACKENDS = [name for name, module in (("orjson", orjson), ("ujson", ujson), ("json", json)) if module is not None]
+
+# every backend raises a ValueError subclass on malformed input
+DecodeError = ValueError
+
+backend = BACKENDS[0]
+
+
+def use(name: str):
+    """Switch to backend `name`, "auto" picks the fastest installed one"""
+    global backend
+    if name == "auto":
+        name = BACKENDS[0]
+    if name not in BACKENDS:
+        raise ValueError(f"JSON backend {name} is not installed")
+    backend = name
+
+
+def dumps(value: Any, indent: bool = False) -> bytes:
+    if backend == "orjson":
+        return orjson.dumps(value, option=orjson.OPT_INDENT_2 if indent else 0)
+    if backend == "ujson":
+        return ujson.dumps(value, ensure_ascii=False, indent=4 if indent else 0).encode()
+    if indent:
+        return json.dumps(value, ensure_ascii=False, indent=4).encode()
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    if backend == "orjson":
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    if backend == "ujson":
+        return ujson.loads(data)
+    return json.loads(data)
@@ -1,7 +1,7 @@
 import os
 import sys
 
-from qtawesome.iconic_font import json
+from lib import codec
 
 
 class ConfigManager:
@@ -31,16 +31,16 @@ class ConfigManager:
                 f.write("{}")
 
         try:
-            with open(self.conf_file, "r") as f:
-                data = json.load(f)
+            with open(self.conf_file, "rb") as f:
+                data = codec.loads(f.read())
                 self.config = data
         except Exception as e:
             print(f"Error loading config: {e}")
 
     def save_config(self):
         if self.config:
-            with open(self.conf_file, "w") as f:
-                json.dump(self.config, f, indent=4)
+            with open(self.conf_file, "wb") as f:
+                f.write(codec.dumps(self.config, indent=True))
 
     def get(self, section, key, default=""):
         return self.config.get(section, {}).get(key, default)
@@ -1,14 +1,34 @@
 import asyncio
-import json
+import concurrent.futures
+import time
 import traceback
+from concurrent.futures import Future
 from threading import Thread
-from typing import Callable, Optional
+from typing import Callable, List, Optional
 
 import websockets
+from websockets.exceptions import ConnectionClosed, ConnectionClosedOK
+
+from lib import codec
+from lib.backoff import Backoff
+from lib.outbound_queue import BACKGROUND, OutboundQueue, lane_of
+from lib.pending_requests import PendingRequests
+from lib.wire_stats import WireStats
 
 
 class Conn:
-    def __init__(self, host: str, port: Optional[str], access_token: Optional[str] = None):
+    def __init__(
+        self,
+        host: str,
+        port: Optional[str],
+        access_token: Optional[str] = None,
+        read_window: float = 0.05,
+        backoff: Optional[Backoff] = None,
+        ping_interval: float = 10.0,
+        compression: Optional[int] = 6,
+        window_bits: Optional[int] = None,
+        background_limit: int = 256,
+    ):
         if port:
             self.uri = f"ws://{host}:{port}/"
         else:
@@ -20,6 +40,27 @@ class Conn:
         self.disconnected_callback: Optional[Callable] = None
         self.on_message_callback: Optional[Callable] = None
 
+        # frames go through one writer coroutine, read receipts and repeated requests are merged
+        self.outbound = OutboundQueue(read_window, background_limit=background_limit)
+        self._outbound_ready = asyncio.Event()
+        # send() calls waiting for room in the background lane
+        self._room_waiters: List[asyncio.Future] = []
+        self.pending = PendingRequests()
+
+        # first retry right away, then exponential with jitter; network_up() cuts a wait short
+        self.backoff = backoff or Backoff()
+        self.ping_interval = ping_interval
+        self._wake = asyncio.Event()
+        self.disconnected_at: Optional[float] = None
+        self.reconnects = 0
+        self.last_connect_ms = 0.0
+        self.last_usable_ms = 0.0
+        self.max_usable_ms = 0.0
+
+        # permessage-deflate at zlib level `compression`, None sends and asks for plain frames
+        self.wire = WireStats()
+        self.extensions = [self.wire.deflate(compression, window_bits)] if compression is not None else None
+
         self.loop = asyncio.new_event_loop()
         self.thread = Thread(target=self._start_loop)
         self._running = True
@@ -30,55 +71,230 @@ class Conn:
 
     async def connect(self):
         while self._running:
+            opened_at = None
+            # before the handshake, frames can be decoded as soon as it's done
+            self.wire.reset()
             try:
-                async with websockets.connect(self.uri) as websocket:
+                # pings notice a dead link in seconds instead of waiting on TCP
+                async with websockets.connect(
+                    self.uri,
+                    ping_interval=self.ping_interval,
+                    ping_timeout=self.ping_interval,
+                    extensions=self.extensions,
+                    compression=None,
+                ) as websocket:
+                    opened_at = time.monotonic()
+                    if self.disconnected_at is not None:
+                        self.last_connect_ms = (opened_at - self.disconnected_at) * 1000
                     self.websocket = websocket
+                    writer = asyncio.create_task(self._write(websocket))
                     if self.connected_callback:
                         self.connected_callback()
 
                     if self.access_token:
-                        self.send_data({
+                        self._enqueue({
                             "action": "authenticate",
                             "data": {"access_token": self.access_token}
                         })
 
-                    await self.listen()
+                    try:
+                        await self.listen()
+                    finally:
+                        writer.cancel()
+                        self.websocket = None
+                        # like before, nothing is sent for a connection that went away
+                        self.outbound.clear()
+                        self._wake_senders()
+                        self.pending.fail_all(ConnectionError("connection closed"))
             except Exception as e:
-                print("Disconnected, retrying in 5 seconds...", e)
-                if self.disconnected_callback:
-                    self.disconnected_callback()
-                await asyncio.sleep(5)
+                print("Connection failed:", e)
+            if not self._running:
+                break
+
+            if opened_at is not None and time.monotonic() - opened_at > 5 * self.ping_interval:
+                # the link was fine for a while, this is a fresh outage
+                self.backoff.reset()
+            # tell the app once per outage, not on every failed attempt
+            if self.disconnected_callback and (opened_at is not None or self.disconnected_at is None):
+                self.disconnected_callback()
+            if self.disconnected_at is None:
+                self.disconnected_at = time.monotonic()
+            delay = self.backoff.next_delay()
+            print(f"Disconnected, retrying in {delay:.1f} seconds...")
+            await self._wait(delay)
+
+    async def _wait(self, delay: float):
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def network_up(self):
+        """The OS reports the network is back, retry now instead of sitting out the backoff"""
+        def wake():
+            self.backoff.reset()
+            self._wake.set()
+        self.loop.call_soon_threadsafe(wake)
+
+    def mark_usable(self):
+        """The session is synced again after a reconnect, records how long the outage was"""
+        # on the connection's loop, which owns the outage bookkeeping
+        self.loop.call_soon_threadsafe(self._mark_usable)
+
+    def _mark_usable(self):
+        if self.disconnected_at is None or self.websocket is None:
+            # a late frame of a connection that is gone, the current outage isn't over
+            return
+        self.last_usable_ms = (time.monotonic() - self.disconnected_at) * 1000
+        self.max_usable_ms = max(self.max_usable_ms, self.last_usable_ms)
+        self.reconnects += 1
+        self.disconnected_at = None
+        self.backoff.reset()
+
+    def reconnect_stats(self) -> dict:
+        return {
+            "connected": self.websocket is not None,
+            "attempts": self.backoff.attempts,
+            "reconnects": self.reconnects,
+            "last_connect_ms": round(self.last_connect_ms, 1),
+            "last_usable_ms": round(self.last_usable_ms, 1),
+            "max_usable_ms": round(self.max_usable_ms, 1),
+        }
+
+    def traffic_stats(self) -> dict:
+        """Frames and bytes per action, raw JSON against what went over the wire"""
+        return self.wire.stats()
 
     async def listen(self):
         try:
             if self.websocket:
-                async for message in self.websocket:
-                    self.on_message(message)
+                while True:
+                    # undecoded bytes, the codec parses UTF-8 directly
+                    self.on_message(await self.websocket.recv(decode=False))
+        except ConnectionClosedOK:
+            pass
         except Exception as e:
             print(traceback.format_exc())
             print("Error in listen:", e)
 
     def on_message(self, message):
+        action = None
         try:
-            data = json.loads(message)
+            data = codec.loads(message)
+            action = data.get("action")
+            self.outbound.answered(data)
+            self.pending.resolve(data)
             if self.on_message_callback:
                 self.on_message_callback(data)
-        except json.JSONDecodeError:
+        except codec.DecodeError:
             print("invalid json")
+        finally:
+            self.wire.received(action, len(message))
 
-    async def _send(self, message: str):
-        if self.websocket:
-            await self.websocket.send(message)
+    async def _write(self, websocket):
+        outbound = self.outbound
+        # only the connection closing ends the writer, anything else costs one frame at most
+        while True:
+            try:
+                due = outbound.next_due()
+                try:
+                    await asyncio.wait_for(self._outbound_ready.wait(), None if due is None else max(due - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    pass
+                self._outbound_ready.clear()
+                # one at a time, a frame pushed while a slow send is waiting can still go ahead of background ones
+                while (body := outbound.pop_next()) is not None:
+                    self._wake_senders()
+                    await self._write_frame(websocket, body)
+            except ConnectionClosed:
+                return
+            except Exception as e:
+                print(traceback.format_exc())
+                print("Error in writer:", e)
+
+    async def _write_frame(self, websocket, body: dict):
+        try:
+            # still a text frame, the server reads JSON text
+            payload = codec.dumps(body)
+            await websocket.send(payload, text=True)
+        except ConnectionClosed:
+            raise
+        except Exception as e:
+            print(traceback.format_exc())
+            print("Dropped outgoing frame:", body.get("action"), e)
+            self.outbound.failed += 1
+            if "request_id" in body:
+                self.pending.fail(body["request_id"], e)
+            return
+        self.outbound.sent(body)
+        self.wire.sent(body.get("action"), len(payload))
+
+    def _enqueue(self, body: dict, lane: Optional[str] = None):
+        if self.websocket is None:
+            self.outbound.discarded += 1
+            return
+        self.outbound.push(body, lane)
+        self._outbound_ready.set()
+
+    def _wake_senders(self):
+        while self._room_waiters and (self.websocket is None or self.outbound.has_room(BACKGROUND)):
+            waiter = self._room_waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def send_data(self, body: dict, lane: Optional[str] = None):
+        """
+        Queue `body` from any thread without waiting. A full background lane
+        still takes it, producers of bulk traffic use send() or send_blocking()
+        """
+        self.loop.call_soon_threadsafe(self._enqueue, body, lane)
+
+    async def send(self, body: dict, lane: Optional[str] = None):
+        """Queue `body` from a coroutine on the connection's loop, waiting while its lane is full"""
+        lane = lane or lane_of(body)
+        while self.websocket is not None and not self.outbound.has_room(lane):
+            waiter = self.loop.create_future()
+            self._room_waiters.append(waiter)
+            await waiter
+        self._enqueue(body, lane)
+
+    def send_blocking(self, body: dict, lane: Optional[str] = None, timeout: Optional[float] = None) -> bool:
+        """send() from a worker thread, never the GUI one; False if the lane stayed full for `timeout`"""
+        future = asyncio.run_coroutine_threadsafe(self.send(body, lane), self.loop)
+        try:
+            future.result(timeout)
+            return True
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return False
+
+    def request(self, action: str, data: Optional[dict] = None, timeout: float = 10.0) -> Future:
+        """
+        Send `action` and return a future of its response frame, from any thread.
+        The response still reaches on_message_callback like every other frame.
+        """
+        data = data or {}
+        request_id, future = self.pending.start(action, codec.dumps(data), data.get("chat_id"))
+        if request_id is not None:
+            body = {"action": action, "data": data, "request_id": request_id}
+            self.loop.call_soon_threadsafe(self._send_request, body, timeout)
+        return future
 
-    def send_data(self, body: dict):
-        message = json.dumps(body)
-        self.loop.call_soon_threadsafe(lambda: asyncio.create_task(self._send(message)))
+    def _send_request(self, body: dict, timeout: float):
+        request_id = body["request_id"]
+        if self.websocket is None:
+            self.pending.fail(request_id, ConnectionError("not connected"))
+            return
+        self._enqueue(body)
+        self.loop.call_later(timeout, self.pending.fail, request_id, TimeoutError(f"{body['action']} timed out"))
 
     def start(self):
         self.thread.start()
 
     def stop(self):
         self._running = False
+        self.loop.call_soon_threadsafe(self._wake.set)
         if self.websocket:
             self.loop.call_soon_threadsafe(lambda: asyncio.create_task(self.websocket.close())) # type: ignore
         self.thread.join()
@@ -0,0 +1,90 @@
+import time
+from collections import deque
+from threading import Lock
+from typing import Any, Callable
+
+
+class InboundQueue:
+    """
+    Decoded frames handed from the network thread to the GUI thread.
+
+    `put()` is called by the reader and only appends to a deque, it never
+    waits on the GUI. `drain()` runs on the GUI thread and handles frames
+    until the queue is empty or the frame budget is spent, so a burst is
+    spread over several event loop iterations instead of freezing the window.
+    `put()` returns True when the drainer is idle and has to be woken.
+    """
+
+    def __init__(self, budget: float = 0.008):
+        self.budget = budget
+        self._frames: deque = deque()
+        # only guards the idle flag, so a wakeup can't be lost between the last pop and going idle
+        self._wake_lock = Lock()
+        self._idle = True
+
+        self.received = 0
+        self.handled = 0
+        self.max_depth = 0
+        self.drains = 0
+        self.yields = 0
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        self.total_lag_ms = 0.0
+        self.max_drain_ms = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._frames)
+
+    def put(self, frame: Any) -> bool:
+        self._frames.append((time.perf_counter(), frame))
+        self.received += 1
+        self.max_depth = max(self.max_depth, len(self._frames))
+        with self._wake_lock:
+            wake, self._idle = self._idle, False
+        return wake
+
+    def drain(self, handle: Callable[[Any], None]) -> bool:
+        """Handle frames for up to `budget` seconds, returns True if some are left for the next iteration"""
+        started = time.perf_counter()
+        deadline = started + self.budget
+        self.drains += 1
+        frames = self._frames
+        while frames:
+            received_at, frame = frames.popleft()
+            lag_ms = (time.perf_counter() - received_at) * 1000
+            self.last_lag_ms = lag_ms
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            self.total_lag_ms += lag_ms
+            try:
+                handle(frame)
+            except Exception as e:
+                print("Error handling frame:", e)
+            self.handled += 1
+            if frames and time.perf_counter() >= deadline:
+                self.yields += 1
+                self._finish(started)
+                return True
+
+        with self._wake_lock:
+            # a frame put after the loop ended still needs this drainer
+            self._idle = not frames
+        self._finish(started)
+        return not self._idle
+
+    def _finish(self, started: float):
+        self.max_drain_ms = max(self.max_drain_ms, (time.perf_counter() - started) * 1000)
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._frames),
+            "max_depth": self.max_depth,
+            "received": self.received,
+            "handled": self.handled,
+            "drains": self.drains,
+            "yields": self.yields,
+            "last_lag_ms": round(self.last_lag_ms, 2),
+            "max_lag_ms": round(self.max_lag_ms, 2),
+            "avg_lag_ms": round(self.total_lag_ms / self.handled, 2) if self.handled else 0.0,
+            "max_drain_ms": round(self.max_drain_ms, 2),
+        }
@@ -0,0 +1,202 @@
+import os
+from datetime import datetime
+from threading import Lock, Thread
+from typing import List, Optional
+
+from lib import binary_snapshot, codec
+
+
+class JournalStore:
+    """
+    Snapshot file plus an append-only journal of per-key records.
+
+    Every write appends one line to the journal, so the cost of a write only
+    depends on the size of the value being written. Once the journal grows past
+    `compact_threshold` records it is rotated and folded into the snapshot on a
+    background thread.
+    """
+
+    def __init__(self, name: str, compact_threshold: int = 500, snapshot_format: str = "json"):
+        self.json_snapshot_file = f"{name}.json"
+        self.binary_snapshot_file = f"{name}.snap"
+        self.snapshot_format = snapshot_format
+        self.snapshot_file = self.binary_snapshot_file if snapshot_format == "binary" else self.json_snapshot_file
+        self.journal_file = f"{name}.journal"
+        self.rotated_file = f"{name}.journal.old"
+        self.compact_threshold = compact_threshold
+
+        self._lock = Lock()
+        self._journal = None
+        self._records = 0
+        self._compaction: Optional[Thread] = None
+        # bumped by write_snapshot, a fold started before it is stale
+        self._generation = 0
+
+    def load(self) -> dict:
+        snapshot = self._read_snapshot_file()
+        # a leftover rotated journal means compaction was interrupted
+        for path in (self.rotated_file, self.journal_file):
+            self._records += self._replay(path, snapshot)
+        return snapshot
+
+    def append(self, key: str, value):
+        self._write({"k": key, "v": value, "t": datetime.now().timestamp()})
+
+    def remove(self, key: str):
+        self._write({"k": key, "d": 1, "t": datetime.now().timestamp()})
+
+    def upsert_messages(self, chat_id: str, rows: List[dict], has_more: Optional[bool] = None):
+        record = {"k": f"chat_messages_{chat_id}", "mu": rows, "t": datetime.now().timestamp()}
+        if has_more is not None:
+            record["has_more"] = has_more
+        self._write(record)
+
+    def delete_messages(self, chat_id: str, ids: List[str]):
+        self._write({"k": f"chat_messages_{chat_id}", "md": ids, "t": datetime.now().timestamp()})
+
+    def commit(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.flush()
+
+    def write_snapshot(self, snapshot: dict):
+        """Replace the snapshot with `snapshot` and drop all journaled records"""
+        with self._lock:
+            self._close_journal()
+            self._write_snapshot_file(snapshot)
+            for path in (self.journal_file, self.rotated_file):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._records = 0
+            self._generation += 1
+
+    def compact(self, wait: bool = False):
+        with self._lock:
+            if self._compaction and self._compaction.is_alive():
+                return
+            # a rotated file left over from an interrupted compaction is folded first
+            if not os.path.exists(self.rotated_file):
+                if not self._records or not os.path.exists(self.journal_file):
+                    return
+                self._close_journal()
+                os.replace(self.journal_file, self.rotated_file)
+                self._records = 0
+            self._compaction = Thread(target=self._fold_rotated, daemon=True)
+            self._compaction.start()
+        if wait:
+            self._compaction.join()
+
+    def close(self):
+        if self._compaction:
+            self._compaction.join()
+        with self._lock:
+            self._close_journal()
+
+    def clear(self):
+        self.close()
+        for path in (self.json_snapshot_file, self.binary_snapshot_file, self.journal_file, self.rotated_file):
+            if os.path.exists(path):
+                os.remove(path)
+        self._records = 0
+
+    def _write(self, record: dict):
+        line = codec.dumps(record) + b"\n"
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_file, "ab")
+            self._journal.write(line)
+            self._records += 1
+            should_compact = self._records >= self.compact_threshold
+        if should_compact:
+            self.compact()
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _fold_rotated(self):
+        # read and replay without the lock so appends aren't held up, write under it
+        with self._lock:
+            generation = self._generation
+        snapshot = self._read_snapshot_file()
+        try:
+            self._replay(self.rotated_file, snapshot)
+        except FileNotFoundError:
+            # removed by write_snapshot while being read
+            return
+        with self._lock:
+            if generation != self._generation or not os.path.exists(self.rotated_file):
+                # write_snapshot replaced everything meanwhile
+                return
+            self._write_snapshot_file(snapshot)
+            os.remove(self.rotated_file)
+
+    def _read_snapshot_file(self) -> dict:
+        # fall back to the other format so switching snapshot_format keeps the cache
+        for path in (self.snapshot_file, self.json_snapshot_file, self.binary_snapshot_file):
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                try:
+                    content = f.read()
+                    if binary_snapshot.is_binary(content):
+                        return binary_snapshot.loads(content)
+                    return codec.loads(content)
+                except Exception as e:
+                    print(e, "error when recovering snapshot")
+        return {}
+
+    def _write_snapshot_file(self, snapshot: dict):
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with open(tmp_file, "wb") as f:
+            if self.snapshot_format == "binary":
+                f.write(binary_snapshot.dumps(snapshot))
+            else:
+                f.write(codec.dumps(snapshot))
+        os.replace(tmp_file, self.snapshot_file)
+        # don't leave a stale snapshot of the other format behind
+        for path in (self.json_snapshot_file, self.binary_snapshot_file):
+            if path != self.snapshot_file and os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def _replay(path: str, snapshot: dict) -> int:
+        if not os.path.exists(path):
+            return 0
+
+        count = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = codec.loads(line)
+                except codec.DecodeError:
+                    # torn write at the end of the journal
+                    continue
+                if record.get("d"):
+                    snapshot.pop(record["k"], None)
+                elif "mu" in record or "md" in record:
+                    _apply_message_record(snapshot.setdefault(record["k"], {"messages": [], "has_more": False}), record)
+                else:
+                    snapshot[record["k"]] = record["v"]
+                snapshot["last_updated_time"] = max(record.get("t", 0), snapshot.get("last_updated_time") or 0)
+                count += 1
+        return count
+
+
+def _apply_message_record(value: dict, record: dict):
+    messages = value.setdefault("messages", [])
+    if record.get("md"):
+        removed = set(record["md"])
+        messages[:] = [message for message in messages if message.get("id") not in removed]
+    if record.get("mu"):
+        positions = {message.get("id"): index for index, message in enumerate(messages)}
+        for row in record["mu"]:
+            if row.get("id") in positions:
+                messages[positions[row["id"]]] = row
+            else:
+                positions[row.get("id")] = len(messages)
+                messages.append(row)
+        messages.sort(key=lambda message: message.get("time") or 0)
+    if "has_more" in record:
+        value["has_more"] = record["has_more"]
@@ -0,0 +1,195 @@
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+# sync, paging and receipts wait behind whatever the user is doing
+BACKGROUND_ACTIONS = {"get_chats", "get_updates", "get_messages", "read_message"}
+
+# upper bounds of the queue time histogram buckets, in milliseconds
+QUEUE_TIME_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+def lane_of(body: dict) -> str:
+    return BACKGROUND if body.get("action") in BACKGROUND_ACTIONS else INTERACTIVE
+
+
+class OutboundQueue:
+    """
+    Frames waiting for Conn's writer, merged where the protocol allows it.
+
+    Frames go into one of two lanes: the interactive one (sending, editing,
+    deleting, authenticating, anything not listed in BACKGROUND_ACTIONS) is
+    always written first, the background one (sync, paging, read receipts)
+    after it. Each lane keeps the order frames were pushed in. The background
+    lane holds `background_limit` frames before `has_room()` turns False,
+    producers that can wait check it first; interactive frames are never
+    refused.
+
+    `read_message` frames of a chat are held for `read_window` seconds and
+    their message ids unioned into one frame. A `get_messages` identical to
+    one still queued or waiting for its answer (same chat and cursor) is
+    dropped. Only used from the connection's event loop, so there is no
+    locking.
+    """
+
+    def __init__(self, read_window: float = 0.05, answer_timeout: float = 10.0, background_limit: int = 256):
+        self.read_window = read_window
+        self.answer_timeout = answer_timeout
+        self.background_limit = background_limit
+        # lane -> (frame, queued at)
+        self._lanes: Dict[str, Deque[Tuple[dict, float]]] = {INTERACTIVE: deque(), BACKGROUND: deque()}
+        self._reads: Dict[Optional[str], Tuple[dict, float]] = {}
+        self._reads_due: Optional[float] = None
+        self._queued_cursors: Set[Tuple] = set()
+        # cursor -> (chat id, sent at) of get_messages not answered yet
+        self._in_flight: Dict[Tuple, Tuple[Optional[str], float]] = {}
+        self._queue_times = {INTERACTIVE: _QueueTimes(), BACKGROUND: _QueueTimes()}
+
+        self.pushed = 0
+        self.sent_frames = 0
+        self.merged = 0
+        self.duplicates = 0
+        # background frames pushed while the lane was full, by producers that can't wait
+        self.overflow = 0
+        # frames forgotten because the connection went away
+        self.discarded = 0
+        # frames the writer couldn't encode or send
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._lanes[INTERACTIVE]) + self.queued(BACKGROUND)
+
+    def queued(self, lane: str) -> int:
+        if lane == BACKGROUND:
+            return len(self._lanes[BACKGROUND]) + len(self._reads)
+        return len(self._lanes[lane])
+
+    def has_room(self, lane: str) -> bool:
+        return lane == INTERACTIVE or self.queued(BACKGROUND) < self.background_limit
+
+    def push(self, body: dict, lane: Optional[str] = None):
+        self.pushed += 1
+        lane = lane or lane_of(body)
+        if not self.has_room(lane):
+            self.overflow += 1
+        action, data = body.get("action"), body.get("data") or {}
+        if action == "read_message":
+            self._push_read(data)
+        elif action == "get_messages" and "request_id" not in body:
+            # requests are shared by Conn.request() instead
+            cursor = tuple(sorted(data.items()))
+            if cursor in self._queued_cursors or self._waiting(cursor):
+                self.duplicates += 1
+                return
+            self._queued_cursors.add(cursor)
+            self._lanes[lane].append((body, time.monotonic()))
+        else:
+            self._lanes[lane].append((body, time.monotonic()))
+
+    def _push_read(self, data: dict):
+        chat_id = data.get("chat_id")
+        pending = self._reads.get(chat_id)
+        if pending is None:
+            now = time.monotonic()
+            self._reads[chat_id] = ({"action": "read_message", "data": {**data, "message_ids": list(data.get("message_ids") or [])}}, now)
+            if self._reads_due is None:
+                self._reads_due = now + self.read_window
+            return
+        message_ids = pending[0]["data"]["message_ids"]
+        known = set(message_ids)
+        message_ids.extend(message_id for message_id in data.get("message_ids") or [] if message_id not in known)
+        self.merged += 1
+
+    def _waiting(self, cursor: Tuple) -> bool:
+        in_flight = self._in_flight.get(cursor)
+        return in_flight is not None and time.monotonic() - in_flight[1] < self.answer_timeout
+
+    def sent(self, body: dict):
+        """The writer wrote `body` to the socket"""
+        self.sent_frames += 1
+        if body.get("action") == "get_messages" and "request_id" not in body:
+            data = body.get("data") or {}
+            self._in_flight[tuple(sorted(data.items()))] = (data.get("chat_id"), time.monotonic())
+
+    def answered(self, body: dict):
+        """A frame came in, a page of messages answers the get_messages of its chat"""
+        if body.get("action") == "get_messages" and self._in_flight:
+            chat_id = ((body.get("data") or {}).get("chat") or {}).get("id")
+            self._in_flight = {cursor: value for cursor, value in self._in_flight.items() if value[0] != chat_id}
+
+    def next_due(self) -> Optional[float]:
+        """When held read receipts have to go out, None if there are none"""
+        return self._reads_due
+
+    def pop_next(self, now: Optional[float] = None) -> Optional[dict]:
+        """The frame to write now, interactive ones first; None if there is none yet"""
+        now = now if now is not None else time.monotonic()
+        if self._reads_due is not None and now >= self._reads_due:
+            self._lanes[BACKGROUND].extend(self._reads.values())
+            self._reads = {}
+            self._reads_due = None
+        for lane in (INTERACTIVE, BACKGROUND):
+            if self._lanes[lane]:
+                body, queued_at = self._lanes[lane].popleft()
+                if body.get("action") == "get_messages" and "request_id" not in body:
+                    self._queued_cursors.discard(tuple(sorted((body.get("data") or {}).items())))
+                self._queue_times[lane].add(now - queued_at)
+                return body
+        return None
+
+    def clear(self) -> int:
+        """Forget every queued frame, returns how many there were"""
+        count = len(self)
+        for frames in self._lanes.values():
+            frames.clear()
+        self._queued_cursors.clear()
+        self._reads = {}
+        self._reads_due = None
+        self._in_flight = {}
+        self.discarded += count
+        return count
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self),
+            "pushed": self.pushed,
+            "sent": self.sent_frames,
+            "merged": self.merged,
+            "duplicates": self.duplicates,
+            "overflow": self.overflow,
+            "discarded": self.discarded,
+            "failed": self.failed,
+            "frames_saved": self.merged + self.duplicates,
+            "lanes": {
+                lane: {"queued": self.queued(lane), **queue_times.stats()}
+                for lane, queue_times in self._queue_times.items()
+            },
+        }
+
+
+class _QueueTimes:
+    """How long frames of a lane waited between push and write"""
+
+    def __init__(self, samples: int = 500):
+        self.buckets = [0] * (len(QUEUE_TIME_BUCKETS_MS) + 1)
+        self._samples: Deque[float] = deque(maxlen=samples)
+
+    def add(self, seconds: float):
+        ms = seconds * 1000
+        self.buckets[bisect_left(QUEUE_TIME_BUCKETS_MS, ms)] += 1
+        self._samples.append(ms)
+
+    def stats(self) -> dict:
+        ordered = sorted(self._samples)
+        histogram = {f"<={bound}ms": count for bound, count in zip(QUEUE_TIME_BUCKETS_MS, self.buckets)}
+        histogram[f">{QUEUE_TIME_BUCKETS_MS[-1]}ms"] = self.buckets[-1]
+        return {
+            "written": sum(self.buckets),
+            "p50_ms": round(ordered[len(ordered) // 2], 2) if ordered else 0.0,
+            "p95_ms": round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], 2) if ordered else 0.0,
+            "max_ms": round(ordered[-1], 2) if ordered else 0.0,
+            "histogram": histogram,
+        }
@@ -0,0 +1,136 @@
+import itertools
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from threading import Lock
+from typing import Deque, Dict, Optional, Tuple
+
+
+@dataclass(slots=True)
+class _Pending:
+    action: str
+    key: Tuple[str, bytes]
+    future: Future
+    started: float
+    chat_id: Optional[str] = None
+
+
+class PendingRequests:
+    """
+    Requests sent with Conn.request() that wait for their response.
+
+    Every request gets a `request_id` the response is matched by. Responses
+    that don't carry one are matched to the oldest pending request of the same
+    action (and chat, for answers that name one), the server answers a
+    connection's frames in order. Futures are
+    `concurrent.futures.Future`s so any thread can wait on or cancel them.
+    An identical request that is still pending shares its future instead of
+    going out again. A cancelled request keeps its place until its response
+    or timeout comes, so responses without an id still line up.
+    """
+
+    def __init__(self, samples: int = 200):
+        self._lock = Lock()
+        self._pending: Dict[str, _Pending] = {}
+        self._by_key: Dict[Tuple[str, bytes], str] = {}
+        self._ids = itertools.count(1)
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._samples = samples
+
+        self.sent = 0
+        self.shared = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self, action: str, key: bytes, chat_id: Optional[str] = None) -> Tuple[Optional[str], Future]:
+        """Register a request, returns its id and future; the id is None if an identical one is pending"""
+        with self._lock:
+            request_id = self._by_key.get((action, key))
+            if request_id is not None and not self._pending[request_id].future.done():
+                self.shared += 1
+                return None, self._pending[request_id].future
+            request_id = f"r{next(self._ids)}"
+            future = Future()
+            self._pending[request_id] = _Pending(action, (action, key), future, time.perf_counter(), chat_id)
+            self._by_key[(action, key)] = request_id
+            self.sent += 1
+        future.add_done_callback(self._count_cancelled)
+        return request_id, future
+
+    def resolve(self, frame: dict) -> bool:
+        """Complete the request `frame` answers, False if it answers none"""
+        with self._lock:
+            request_id = frame.get("request_id")
+            if request_id not in self._pending:
+                action = frame.get("action")
+                chat_id = ((frame.get("data") or {}).get("chat") or {}).get("id")
+                request_id = next((
+                    key for key, pending in self._pending.items()
+                    if pending.action == action and (chat_id is None or pending.chat_id in (None, chat_id))
+                ), None)
+            pending = self._pop(request_id)
+            if pending is None:
+                return False
+            latency = time.perf_counter() - pending.started
+            self._latencies.setdefault(pending.action, deque(maxlen=self._samples)).append(latency)
+            self.completed += 1
+        if not pending.future.done():
+            pending.future.set_result(frame)
+        return True
+
+    def fail(self, request_id: str, error: Exception):
+        with self._lock:
+            pending = self._pop(request_id)
+            if pending is None:
+                return
+            if isinstance(error, TimeoutError):
+                self.timeouts += 1
+            else:
+                self.failed += 1
+        if not pending.future.done():
+            pending.future.set_exception(error)
+
+    def fail_all(self, error: Exception):
+        with self._lock:
+            request_ids = list(self._pending)
+        for request_id in request_ids:
+            self.fail(request_id, error)
+
+    def _count_cancelled(self, future: Future):
+        if future.cancelled():
+            with self._lock:
+                self.cancelled += 1
+
+    def _pop(self, request_id: Optional[str]) -> Optional[_Pending]:
+        pending = self._pending.pop(request_id, None) if request_id is not None else None
+        if pending is not None and self._by_key.get(pending.key) == request_id:
+            del self._by_key[pending.key]
+        return pending
+
+    def stats(self) -> dict:
+        with self._lock:
+            latency = {}
+            for action, samples in self._latencies.items():
+                ordered = sorted(samples)
+                latency[action] = {
+                    "count": len(ordered),
+                    "p50_ms": round(ordered[len(ordered) // 2] * 1000, 2),
+                    "p95_ms": round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1000, 2),
+                    "max_ms": round(ordered[-1] * 1000, 2),
+                }
+            return {
+                "in_flight": len(self._pending),
+                "sent": self.sent,
+                "shared": self.shared,
+                "completed": self.completed,
+                "timeouts": self.timeouts,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+                "latency": latency,
+            }
@@ -0,0 +1,216 @@
+import time
+import traceback
+from contextlib import nullcontext
+from threading import Condition, Thread
+from typing import Any, Callable, ContextManager, Dict, Iterable, List, Optional, Tuple
+
+
+class PersistWorker(Thread):
+    """
+    Writes dirty gv keys to the store from its own thread.
+
+    Callers only mark what changed; everything marked between two flushes is
+    merged into one flush, and flushes happen at most every `interval` seconds.
+    `snapshot_key(key)` returns `(exists, encoded_value)` for a whole key and
+    `encode_message(message)` the stored form of a single message. Both run
+    while holding `lock`, the lock the owner of those values mutates them
+    under, so a flush never sees half an update; writing to the store
+    happens after it is released. A flush that fails is retried with the
+    next one, up to `retries` times in a row.
+    """
+
+    def __init__(
+        self,
+        store,
+        snapshot_key: Callable[[str], Tuple[bool, Any]],
+        encode_message: Callable[[Any], dict],
+        interval: float = 0.25,
+        lock: Optional[ContextManager] = None,
+        retries: int = 3,
+    ):
+        super().__init__(daemon=True)
+        self.store = store
+        self.snapshot_key = snapshot_key
+        self.encode_message = encode_message
+        self.interval = interval
+        self.lock = lock if lock is not None else nullcontext()
+        self.retries = retries
+        self._failures = 0
+
+        self._condition = Condition()
+        self._keys: Dict[str, bool] = {}
+        self._upserted: Dict[str, Dict[str, Any]] = {}
+        self._removed: Dict[str, Dict[str, bool]] = {}
+        self._has_more: Dict[str, Optional[bool]] = {}
+        self._flush_requested = False
+        self._flushed = 0
+        self._running = True
+        self._last_flush = 0.0
+
+        self.marked = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.failed_flushes = 0
+
+    def mark_key(self, key: str):
+        with self._condition:
+            self._keys[key] = True
+            if key.startswith("chat_messages_"):
+                # the whole value gets written, pending deltas are already in it
+                chat_id = key.split("chat_messages_")[1]
+                self._upserted.pop(chat_id, None)
+                self._removed.pop(chat_id, None)
+                self._has_more.pop(chat_id, None)
+            self.marked += 1
+            self._condition.notify()
+
+    def mark_messages(self, chat_id: str, upserted: Iterable = (), removed: Iterable[str] = (), has_more: Optional[bool] = None):
+        with self._condition:
+            chat_upserted = self._upserted.setdefault(chat_id, {})
+            chat_removed = self._removed.setdefault(chat_id, {})
+            for message_id in removed:
+                chat_upserted.pop(message_id, None)
+                chat_removed[message_id] = True
+            for message in upserted:
+                chat_removed.pop(message.id, None)
+                chat_upserted[message.id] = message
+            if has_more is not None:
+                self._has_more[chat_id] = has_more
+            self.marked += 1
+            self._condition.notify()
+
+    @property
+    def pending(self) -> int:
+        with self._condition:
+            return (
+                len(self._keys)
+                + sum(len(messages) for messages in self._upserted.values())
+                + sum(len(ids) for ids in self._removed.values())
+            )
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "marked": self.marked,
+            "flushes": self.flushes,
+            "last_flush_ms": self.last_flush_ms,
+            "max_flush_ms": self.max_flush_ms,
+            "avg_flush_ms": self.total_flush_ms / self.flushes if self.flushes else 0.0,
+            "failed_flushes": self.failed_flushes,
+        }
+
+    def flush(self, timeout: Optional[float] = None):
+        """Flush now instead of waiting for the interval and block until it's written"""
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify()
+            target = self.marked
+            self._condition.wait_for(lambda: self._flushed >= target or not self.is_alive(), timeout)
+
+    def stop(self, flush: bool = True):
+        with self._condition:
+            if not flush:
+                self._discard()
+            self._running = False
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._has_pending() or self._flush_requested or not self._running)
+                if self._running and not self._flush_requested:
+                    # coalesce everything marked until the interval is over
+                    delay = self._last_flush + self.interval - time.monotonic()
+                    if delay > 0:
+                        self._condition.wait_for(lambda: self._flush_requested or not self._running, delay)
+
+                keys, upserted, removed, has_more = self._keys, self._upserted, self._removed, self._has_more
+                self._discard()
+                self._flush_requested = False
+                marked = self.marked
+                running = self._running
+
+            self._write(keys, upserted, removed, has_more)
+
+            with self._condition:
+                self._flushed = marked
+                self._condition.notify_all()
+            if not running:
+                return
+
+    def _requeue(self, keys: dict, upserted: dict, removed: dict, has_more: dict):
+        """Put a failed flush back, under anything marked since, which is newer"""
+        with self._condition:
+            for key in keys:
+                self._keys.setdefault(key, True)
+            for chat_id, messages in upserted.items():
+                if f"chat_messages_{chat_id}" in self._keys:
+                    continue
+                newer_removed = self._removed.get(chat_id, {})
+                chat_upserted = self._upserted.setdefault(chat_id, {})
+                for message_id, message in messages.items():
+                    if message_id not in newer_removed:
+                        chat_upserted.setdefault(message_id, message)
+            for chat_id, ids in removed.items():
+                if f"chat_messages_{chat_id}" in self._keys:
+                    continue
+                newer_upserted = self._upserted.get(chat_id, {})
+                chat_removed = self._removed.setdefault(chat_id, {})
+                for message_id in ids:
+                    if message_id not in newer_upserted:
+                        chat_removed[message_id] = True
+            for chat_id, value in has_more.items():
+                self._has_more.setdefault(chat_id, value)
+
+    def _has_pending(self) -> bool:
+        return bool(self._keys or self._upserted or self._removed or self._has_more)
+
+    def _discard(self):
+        self._keys, self._upserted, self._removed, self._has_more = {}, {}, {}, {}
+
+    def _write(self, keys: dict, upserted: dict, removed: dict, has_more: dict):
+        if not (keys or upserted or removed or has_more):
+            return
+
+        started = time.monotonic()
+        try:
+            with self.lock:
+                snapshots = [(key, *self.snapshot_key(key)) for key in keys]
+                rows: Dict[str, List[dict]] = {
+                    chat_id: [self.encode_message(message) for message in upserted.get(chat_id, {}).values()]
+                    for chat_id in set(upserted) | set(has_more)
+                }
+
+            for key, exists, value in snapshots:
+                if exists:
+                    self.store.append(key, value)
+                else:
+                    self.store.remove(key)
+            for chat_id, ids in removed.items():
+                if ids:
+                    self.store.delete_messages(chat_id, list(ids))
+            for chat_id, chat_rows in rows.items():
+                self.store.upsert_messages(chat_id, chat_rows, has_more.get(chat_id))
+            self.store.commit()
+            self._failures = 0
+        except Exception as e:
+            print(traceback.format_exc())
+            self.failed_flushes += 1
+            self._failures += 1
+            if self._failures <= self.retries:
+                print("Error while persisting, retrying with the next flush:", e)
+                self._requeue(keys, upserted, removed, has_more)
+            else:
+                print("Error while persisting, giving up on these changes:", e)
+                self._failures = 0
+
+        self._last_flush = time.monotonic()
+        elapsed = (self._last_flush - started) * 1000
+        self.flushes += 1
+        self.last_flush_ms = elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+        self.total_flush_ms += elapsed
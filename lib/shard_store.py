@@ -0,0 +1,198 @@
+import os
+import shutil
+from bisect import bisect_left
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from threading import RLock
+from typing import Dict, List, Optional
+
+from lib import codec
+
+
+class ShardStore:
+    """
+    One small global.json plus one chat_<id>.json per chat inside a directory.
+
+    Writes only touch the in-memory copy of a shard and mark it dirty; commit()
+    rewrites the dirty shards and nothing else. Like SqliteStore, load() only
+    returns has_more for each chat and messages are read with query_messages().
+    """
+
+    def __init__(self, name: str, workers: int = 4):
+        self.directory = name
+        self.global_file = os.path.join(name, "global.json")
+        self.workers = workers
+
+        self._lock = RLock()
+        self._global: dict = {}
+        self._shards: Dict[str, List[dict]] = {}
+        self._positions: Dict[str, Dict[str, int]] = {}
+        self._reading: Dict[str, Future] = {}
+        self._dirty_global = False
+        self._dirty_shards: Dict[str, bool] = {}
+        # removed chats, their file is deleted on commit unless messages came back meanwhile
+        self._removed: Dict[str, bool] = {}
+        self._unsorted: Dict[str, bool] = {}
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    def load(self) -> dict:
+        os.makedirs(self.directory, exist_ok=True)
+        self._global = self._read_json(self.global_file) or {}
+
+        # read shards in the background so opening a chat later rarely waits on disk
+        self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        for filename in os.listdir(self.directory):
+            if filename.startswith("chat_") and filename.endswith(".json"):
+                chat_id = filename[len("chat_"):-len(".json")]
+                self._reading[chat_id] = self._pool.submit(self._read_json, self._shard_file(chat_id))
+                self._global.setdefault(f"chat_messages_{chat_id}", {"has_more": False})
+
+        return dict(self._global)
+
+    def query_messages(self, chat_id: str, before: Optional[float], limit: int) -> List[dict]:
+        with self._lock:
+            messages = self._get_shard(chat_id)
+            if self._unsorted.get(chat_id):
+                self._sort_shard(chat_id)
+            end = len(messages) if before is None else bisect_left(messages, before, key=lambda message: message.get("time") or 0)
+            return messages[max(end - limit, 0):end]
+
+    def append(self, key: str, value):
+        with self._lock:
+            if key.startswith("chat_messages_"):
+                chat_id = key.split("chat_messages_")[1]
+                self._shards[chat_id] = list(value.get("messages", []))
+                self._unsorted[chat_id] = True
+                self._dirty_shards[chat_id] = True
+                value = {"has_more": value.get("has_more", False)}
+            self._global[key] = value
+            self._global["last_updated_time"] = datetime.now().timestamp()
+            self._dirty_global = True
+
+    def remove(self, key: str):
+        with self._lock:
+            if key.startswith("chat_messages_"):
+                chat_id = key.split("chat_messages_")[1]
+                self._shards[chat_id] = []
+                self._positions.pop(chat_id, None)
+                self._reading.pop(chat_id, None)
+                self._dirty_shards[chat_id] = True
+                self._removed[chat_id] = True
+            self._global.pop(key, None)
+            self._dirty_global = True
+
+    def upsert_messages(self, chat_id: str, rows: List[dict], has_more: Optional[bool] = None):
+        with self._lock:
+            messages = self._get_shard(chat_id)
+            positions = self._get_positions(chat_id)
+            for row in rows:
+                if row.get("id") in positions:
+                    messages[positions[row["id"]]] = row
+                else:
+                    if messages and (row.get("time") or 0) < (messages[-1].get("time") or 0):
+                        self._unsorted[chat_id] = True
+                    positions[row.get("id")] = len(messages)
+                    messages.append(row)
+            if rows:
+                self._dirty_shards[chat_id] = True
+
+            key = f"chat_messages_{chat_id}"
+            if has_more is not None or key not in self._global:
+                self._global[key] = {"has_more": bool(has_more)}
+            self._global["last_updated_time"] = datetime.now().timestamp()
+            self._dirty_global = True
+
+    def delete_messages(self, chat_id: str, ids: List[str]):
+        with self._lock:
+            removed = set(ids)
+            self._shards[chat_id] = [message for message in self._get_shard(chat_id) if message.get("id") not in removed]
+            self._positions.pop(chat_id, None)
+            self._dirty_shards[chat_id] = True
+
+    def commit(self):
+        with self._lock:
+            dirty_shards, self._dirty_shards = self._dirty_shards, {}
+            removed, self._removed = self._removed, {}
+            for chat_id in dirty_shards:
+                if chat_id in removed and not self._shards[chat_id]:
+                    path = self._shard_file(chat_id)
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+                if self._unsorted.get(chat_id):
+                    self._sort_shard(chat_id)
+                self._write_json(self._shard_file(chat_id), {"messages": self._shards[chat_id]})
+            if self._dirty_global:
+                self._write_json(self.global_file, self._global)
+                self._dirty_global = False
+
+    def write_snapshot(self, snapshot: dict):
+        with self._lock:
+            self._wait_for_reads()
+            self.clear()
+            self._global = {}
+            for key, value in snapshot.items():
+                self.append(key, value)
+            self.commit()
+
+    def compact(self, wait: bool = False):
+        self.commit()
+
+    def close(self):
+        self.commit()
+        self._wait_for_reads()
+
+    def clear(self):
+        with self._lock:
+            self._wait_for_reads()
+            self._shards, self._positions, self._dirty_shards, self._unsorted = {}, {}, {}, {}
+            self._removed = {}
+            self._global = {}
+            self._dirty_global = False
+            if os.path.exists(self.directory):
+                shutil.rmtree(self.directory)
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _get_shard(self, chat_id: str) -> List[dict]:
+        if chat_id not in self._shards:
+            reading = self._reading.pop(chat_id, None)
+            shard = reading.result() if reading else self._read_json(self._shard_file(chat_id))
+            self._shards[chat_id] = (shard or {}).get("messages", [])
+        return self._shards[chat_id]
+
+    def _get_positions(self, chat_id: str) -> Dict[str, int]:
+        if chat_id not in self._positions:
+            self._positions[chat_id] = {message.get("id"): index for index, message in enumerate(self._get_shard(chat_id))}
+        return self._positions[chat_id]
+
+    def _sort_shard(self, chat_id: str):
+        self._shards[chat_id].sort(key=lambda message: message.get("time") or 0)
+        self._positions.pop(chat_id, None)
+        self._unsorted.pop(chat_id, None)
+
+    def _wait_for_reads(self):
+        if self._pool:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        self._reading = {}
+
+    def _shard_file(self, chat_id: str) -> str:
+        return os.path.join(self.directory, f"chat_{chat_id}.json")
+
+    @staticmethod
+    def _read_json(path: str) -> Optional[dict]:
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            try:
+                return codec.loads(f.read())
+            except Exception as e:
+                print(e, "error when reading", path)
+                return None
+
+    @staticmethod
+    def _write_json(path: str, value):
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(codec.dumps(value))
+        os.replace(tmp_file, path)
@@ -0,0 +1,230 @@
+import os
+import sqlite3
+from datetime import datetime
+from threading import Lock
+from typing import List, Optional
+
+from lib import codec
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT,
+    email TEXT,
+    last_seen REAL,
+    full_name TEXT,
+    display_name TEXT,
+    avatar TEXT,
+    is_online INTEGER
+);
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    position INTEGER,
+    last_message TEXT,
+    updated_at REAL,
+    user_id TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    text TEXT,
+    sender TEXT,
+    time REAL,
+    status TEXT,
+    is_mine INTEGER,
+    reply_to TEXT,
+    local_id TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_chat_time ON messages (chat_id, time);
+"""
+
+USER_FIELDS = ["id", "username", "email", "last_seen", "full_name", "display_name", "avatar", "is_online"]
+MESSAGE_FIELDS = ["id", "chat_id", "text", "sender", "time", "status", "is_mine", "reply_to", "local_id"]
+
+
+class SqliteStore:
+    """
+    Same interface as JournalStore, but chats, users and messages live in their
+    own indexed tables so message changes are row upserts and deletes, and
+    history is read in windows with query_messages(). Every other gv key is
+    kept as JSON in the `kv` table.
+    """
+
+    def __init__(self, name: str):
+        self.db_file = f"{name}.db"
+        self._lock = Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def load(self) -> dict:
+        with self._lock:
+            loaded = {key: codec.loads(value) for key, value in self.db.execute("SELECT key, value FROM kv")}
+            loaded["chats"] = self._load_chats()
+        # chat_messages_<id> values only carry has_more, messages are read with query_messages()
+        return loaded
+
+    def query_messages(self, chat_id: str, before: Optional[float], limit: int) -> List[dict]:
+        with self._lock:
+            return self._query_messages(chat_id, before, limit)
+
+    def append(self, key: str, value):
+        with self._lock, self._transaction():
+            if key == "chats":
+                self._write_chats(value)
+            elif key.startswith("chat_messages_"):
+                chat_id = key.split("chat_messages_")[1]
+                self.db.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                self._write_messages(chat_id, value.get("messages", []))
+                self._write_kv(key, {"has_more": value.get("has_more", False)})
+            else:
+                self._write_kv(key, value)
+            self._write_kv("last_updated_time", datetime.now().timestamp())
+
+    def remove(self, key: str):
+        with self._lock, self._transaction():
+            if key == "chats":
+                self.db.execute("DELETE FROM chats")
+            elif key.startswith("chat_messages_"):
+                self.db.execute("DELETE FROM messages WHERE chat_id = ?", (key.split("chat_messages_")[1],))
+            self.db.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def upsert_messages(self, chat_id: str, rows: List[dict], has_more: Optional[bool] = None):
+        with self._lock, self._transaction():
+            self._write_messages(chat_id, rows)
+            if has_more is not None:
+                self._write_kv(f"chat_messages_{chat_id}", {"has_more": has_more})
+            else:
+                self.db.execute(
+                    "INSERT OR IGNORE INTO kv (key, value) VALUES (?, ?)",
+                    (f"chat_messages_{chat_id}", codec.dumps({"has_more": False}).decode()),
+                )
+            self._write_kv("last_updated_time", datetime.now().timestamp())
+
+    def delete_messages(self, chat_id: str, ids: List[str]):
+        with self._lock, self._transaction():
+            self.db.executemany("DELETE FROM messages WHERE id = ?", [(message_id,) for message_id in ids])
+            self._write_kv("last_updated_time", datetime.now().timestamp())
+
+    def commit(self):
+        # every write above already runs in its own transaction
+        pass
+
+    def write_snapshot(self, snapshot: dict):
+        with self._lock, self._transaction():
+            for table in ("kv", "chats", "users", "messages"):
+                self.db.execute(f"DELETE FROM {table}")
+            for key, value in snapshot.items():
+                if key == "chats":
+                    self._write_chats(value)
+                elif key.startswith("chat_messages_"):
+                    chat_id = key.split("chat_messages_")[1]
+                    self._write_messages(chat_id, value.get("messages", []))
+                    self._write_kv(key, {"has_more": value.get("has_more", False)})
+                else:
+                    self._write_kv(key, value)
+
+    def compact(self, wait: bool = False):
+        with self._lock:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def clear(self):
+        self.close()
+        for path in (self.db_file, f"{self.db_file}-wal", f"{self.db_file}-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _transaction(self):
+        return _Transaction(self.db)
+
+    def _write_kv(self, key: str, value):
+        self.db.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, codec.dumps(value).decode()))
+
+    def _write_chats(self, chats: List[dict]):
+        self.db.execute("DELETE FROM chats")
+        for position, chat in enumerate(chats):
+            user = chat.get("user") or {}
+            if user.get("id"):
+                self.db.execute(
+                    f"INSERT OR REPLACE INTO users ({', '.join(USER_FIELDS)}) VALUES ({', '.join('?' * len(USER_FIELDS))})",
+                    [user.get(field) for field in USER_FIELDS],
+                )
+            self.db.execute(
+                "INSERT OR REPLACE INTO chats (id, position, last_message, updated_at, user_id) VALUES (?, ?, ?, ?, ?)",
+                (chat.get("id"), position, chat.get("last_message"), chat.get("updated_at"), user.get("id")),
+            )
+
+    def _load_chats(self) -> List[dict]:
+        columns = ", ".join(f"users.{field}" for field in USER_FIELDS)
+        rows = self.db.execute(
+            f"SELECT chats.id, chats.last_message, chats.updated_at, {columns} "
+            "FROM chats LEFT JOIN users ON users.id = chats.user_id ORDER BY chats.position"
+        )
+        chats = []
+        for row in rows:
+            user = dict(zip(USER_FIELDS, row[3:]))
+            user["is_online"] = bool(user["is_online"])
+            user["display_name"] = user["display_name"] or ""
+            chats.append({"id": row[0], "last_message": row[1], "updated_at": row[2], "user": user})
+        return chats
+
+    def _write_messages(self, chat_id: str, rows: List[dict]):
+        self.db.executemany(
+            f"INSERT OR REPLACE INTO messages ({', '.join(MESSAGE_FIELDS)}) VALUES ({', '.join('?' * len(MESSAGE_FIELDS))})",
+            [
+                (
+                    row["id"], row.get("chat_id") or chat_id, row.get("text"), row.get("sender"), row.get("time"),
+                    row.get("status"), int(bool(row.get("is_mine"))),
+                    codec.dumps(row["reply_to"]).decode() if row.get("reply_to") else None, row.get("local_id"),
+                )
+                for row in rows
+            ],
+        )
+
+    def _query_messages(self, chat_id: str, before: Optional[float], limit: int) -> List[dict]:
+        if before is None:
+            cursor = self.db.execute(
+                f"SELECT {', '.join(MESSAGE_FIELDS)} FROM messages WHERE chat_id = ? ORDER BY time DESC LIMIT ?",
+                (chat_id, limit),
+            )
+        else:
+            cursor = self.db.execute(
+                f"SELECT {', '.join(MESSAGE_FIELDS)} FROM messages WHERE chat_id = ? AND time < ? ORDER BY time DESC LIMIT ?",
+                (chat_id, before, limit),
+            )
+        messages = []
+        for row in cursor:
+            message = dict(zip(MESSAGE_FIELDS, row))
+            message["is_mine"] = bool(message["is_mine"])
+            message["reply_to"] = codec.loads(message["reply_to"]) if message["reply_to"] else None
+            messages.append(message)
+        messages.reverse()
+        return messages
+
+
+class _Transaction:
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
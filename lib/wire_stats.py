@@ -0,0 +1,120 @@
+from collections import deque
+from threading import Lock
+from typing import Deque, Dict, List, Optional, Sequence
+
+from websockets.extensions.base import Extension
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+from websockets.frames import CTRL_OPCODES, Frame
+
+
+class WireStats:
+    """
+    Bytes Conn moved per action, raw (the JSON) and on the wire (the message
+    payload after permessage-deflate, without frame headers).
+
+    With compression negotiated, the extension built by `deflate()` records
+    the compressed size of every message it encodes or decodes, and Conn
+    pairs those up with the frames it sends and receives, in order. Without
+    it both sizes are the same. Counted on the connection's thread, read from
+    any.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # action -> [frames in, raw in, wire in, frames out, raw out, wire out]
+        self._actions: Dict[Optional[str], List[int]] = {}
+        self._wire_in: Deque[int] = deque()
+        self._wire_out: Deque[int] = deque()
+
+    def deflate(self, level: int = 6, window_bits: Optional[int] = None) -> "_CountingDeflateFactory":
+        """
+        Client side permessage-deflate offer: `level` is the zlib level of what
+        this client sends, `window_bits` the largest window the server may
+        compress with (smaller costs the server less memory, compresses worse)
+        """
+        return _CountingDeflateFactory(
+            self,
+            server_max_window_bits=window_bits,
+            compress_settings={"level": level, "memLevel": 5},
+        )
+
+    def reset(self):
+        """A new connection, sizes of the old one's messages won't be paired anymore"""
+        self._wire_in.clear()
+        self._wire_out.clear()
+
+    def received(self, action: Optional[str], raw: int):
+        wire = self._wire_in.popleft() if self._wire_in else raw
+        with self._lock:
+            counts = self._actions.setdefault(action, [0] * 6)
+            counts[0] += 1
+            counts[1] += raw
+            counts[2] += wire
+
+    def sent(self, action: Optional[str], raw: int):
+        wire = self._wire_out.popleft() if self._wire_out else raw
+        with self._lock:
+            counts = self._actions.setdefault(action, [0] * 6)
+            counts[3] += 1
+            counts[4] += raw
+            counts[5] += wire
+
+    def stats(self) -> dict:
+        with self._lock:
+            actions = {action: list(counts) for action, counts in self._actions.items()}
+        total = [sum(column) for column in zip(*actions.values())] if actions else [0] * 6
+        result = {str(action): _describe(counts) for action, counts in actions.items()}
+        result["total"] = _describe(total)
+        return result
+
+
+def _describe(counts: Sequence[int]) -> dict:
+    frames_in, raw_in, wire_in, frames_out, raw_out, wire_out = counts
+    return {
+        "frames_in": frames_in,
+        "raw_in": raw_in,
+        "wire_in": wire_in,
+        "frames_out": frames_out,
+        "raw_out": raw_out,
+        "wire_out": wire_out,
+        "ratio_in": round(wire_in / raw_in, 3) if raw_in else 1.0,
+        "ratio_out": round(wire_out / raw_out, 3) if raw_out else 1.0,
+    }
+
+
+class _CountingDeflateFactory(ClientPerMessageDeflateFactory):
+    def __init__(self, stats: WireStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    def process_response_params(self, params, accepted_extensions):
+        extension = super().process_response_params(params, accepted_extensions)
+        return _Counting(extension, self.stats)
+
+
+class _Counting(Extension):
+    """Wraps the negotiated PerMessageDeflate, records the payload size of each whole message"""
+
+    def __init__(self, extension: Extension, stats: WireStats):
+        self.extension = extension
+        self.name = extension.name
+        self.stats = stats
+        self._decoding = 0
+        self._encoding = 0
+
+    def decode(self, frame: Frame, *, max_size: Optional[int] = None) -> Frame:
+        if frame.opcode not in CTRL_OPCODES:
+            self._decoding += len(frame.data)
+            if frame.fin:
+                self.stats._wire_in.append(self._decoding)
+                self._decoding = 0
+        return self.extension.decode(frame, max_size=max_size)
+
+    def encode(self, frame: Frame) -> Frame:
+        frame = self.extension.encode(frame)
+        if frame.opcode not in CTRL_OPCODES:
+            self._encoding += len(frame.data)
+            if frame.fin:
+                self.stats._wire_out.append(self._encoding)
+                self._encoding = 0
+        return frame
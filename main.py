@@ -3,7 +3,8 @@ import sys
 from typing import Optional
 
 from PySide6 import QtGui, QtWidgets
-from PySide6.QtCore import QSettings, Qt, Signal
+from PySide6.QtCore import QSettings, Qt, QTimer, Signal
+from PySide6.QtNetwork import QNetworkInformation
 
 import env
 from components.main.chat_list import ChatList
@@ -11,10 +12,14 @@ from components.main.chatbox import ChatBox
 from components.main.login import Login
 from components.main.settings_modal import SettingsModal
 from components.main.sidebar import Sidebar
+from lib.backoff import Backoff
 from lib.config import ConfigManager
 from lib.conn import Conn
+from lib.inbound_queue import InboundQueue
 from utils import gv  # gv standas for global variable, because can't use global
 from utils.action_handler import ActionHandler
+from utils.outbox import Outbox
+from utils.payload_decoder import PayloadDecoder
 
 
 class ChatApp(QtWidgets.QMainWindow):
@@ -22,6 +27,9 @@ class ChatApp(QtWidgets.QMainWindow):
     search_results_received = Signal(list)
     fetched_messages = Signal(list, bool, bool)
     on_logout = Signal()
+    inbound_ready = Signal()
+    connection_opened = Signal()
+    connection_lost = Signal()
 
     def __init__(self, settings_instance: str):
         super().__init__()
@@ -29,17 +37,32 @@ class ChatApp(QtWidgets.QMainWindow):
         self.settings = QSettings("Veia Sp.", settings_instance)
         self.refresh_token = settings.value("refresh_token")
         self.access_token = settings.value("access_token")
-        self.conn = Conn(env.HOST, env.PORT, self.access_token)
-        self.conn.connected_callback = self.on_connect
-        self.conn.disconnected_callback = self.on_disconnect
+        self.conn = Conn(
+            env.HOST,
+            env.PORT,
+            self.access_token,
+            read_window=env.READ_RECEIPT_WINDOW_MS / 1000,
+            backoff=Backoff(env.RECONNECT_BASE_MS / 1000, env.RECONNECT_MAX_MS / 1000),
+            compression=env.WS_DEFLATE_LEVEL if env.WS_COMPRESSION == "deflate" else None,
+            window_bits=env.WS_DEFLATE_WINDOW_BITS or None,
+            background_limit=env.OUTBOUND_BACKGROUND_LIMIT,
+        )
+        # called on the connection thread, handled on the GUI thread in order with the frames
+        self.conn.connected_callback = self.connection_opened.emit
+        self.conn.disconnected_callback = self.connection_lost.emit
+        self.connection_opened.connect(self.on_connect, Qt.ConnectionType.QueuedConnection)
+        self.connection_lost.connect(self.on_disconnect, Qt.ConnectionType.QueuedConnection)
         self.conn.on_message_callback = self.on_message
+        # frames are handled on this (the GUI) thread, a few milliseconds per event loop iteration
+        self.inbound = InboundQueue(env.INBOUND_FRAME_BUDGET_MS / 1000)
+        self.decoder = PayloadDecoder()
+        self.inbound_ready.connect(self.drain_inbound, Qt.ConnectionType.QueuedConnection)
 
         gv.signal_manager.selected_chat_changed.connect(self.selected_chat_changed)
         gv.signal_manager.sidebar_opened_changed.connect(self.toggle_sidebar)
 
         self.user: Optional[dict] = None
         self.connected = False
-        self.chats = []
         self.chatboxes = {}
 
         self.sidebar_opened = False
@@ -93,8 +116,30 @@ class ChatApp(QtWidgets.QMainWindow):
         self.search_results_received.connect(self.chat_list.load_search_results)
         self.on_logout.connect(self.logout)
         gv.load_data()
+        self.decoder.user_id = (gv.get("user") or {}).get("id")
+        self.outbox = Outbox(
+            gv.state,
+            gv.send_data,
+            lambda: bool(gv.get("is_authenticated")),
+            max_in_flight=env.OUTBOX_MAX_IN_FLIGHT,
+            ack_timeout=env.OUTBOX_ACK_TIMEOUT_MS / 1000,
+        )
+        # retries of messages the server didn't confirm in time
+        self.outbox_timer = QTimer(self)
+        self.outbox_timer.timeout.connect(self.outbox.flush)
+        self.outbox_timer.start(1000)
         self.conn.start()
         gv.set_conn(self.conn)
+        self.watch_network()
+
+    def watch_network(self):
+        # not every platform has a reachability backend, then only the backoff applies
+        if QNetworkInformation.loadDefaultBackend() and QNetworkInformation.instance():
+            QNetworkInformation.instance().reachabilityChanged.connect(self.on_reachability_changed)
+
+    def on_reachability_changed(self, reachability):
+        if reachability == QNetworkInformation.Reachability.Online:
+            self.conn.network_up()
 
     def setup_shortcuts(self):
         ctrlTab = QtGui.QShortcut(QtGui.QKeySequence("Ctrl+Tab"), self)
@@ -103,37 +148,38 @@ class ChatApp(QtWidgets.QMainWindow):
         ctrlShiftTab.activated.connect(self.select_previous_chat)
 
     def select_next_chat(self):
-        for index, chat in enumerate(self.chats):
-            if chat == gv.get("selected_chat"):
-                if index == len(self.chats) - 1:
-                    self.select_chat_by_id(self.chats[0].id)
-                else:
-                    self.select_chat_by_id(self.chats[index + 1].id)
-                break
+        self.select_neighbour_chat(1)
 
     def select_previous_chat(self):
-        for index, chat in enumerate(self.chats):
-            if chat == gv.get("selected_chat"):
-                if index == 0:
-                    self.select_chat_by_id(self.chats[-1].id)
-                else:
-                    self.select_chat_by_id(self.chats[index - 1].id)
-                break
+        self.select_neighbour_chat(-1)
+
+    def select_neighbour_chat(self, step):
+        selected_chat = gv.get("selected_chat")
+        if selected_chat:
+            chat = gv.state.chat_index.neighbour(selected_chat.id, step)
+            if chat:
+                self.select_chat_by_id(chat.id)
 
     def select_chat_by_id(self, chat_id):
-        for chat in self.chats:
-            if chat.id == chat_id:
-                gv.set("selected_chat", chat)
-                self.chat_list.set_active_item_by_id(chat.id)
+        chat = gv.state.chat_index.get(chat_id)
+        if chat:
+            gv.set("selected_chat", chat)
+            self.chat_list.set_active_item_by_id(chat.id)
 
     def selected_chat_changed(self, chat):
-        if not self.chatboxes.get(chat.id):
+        chatbox = self.chatboxes.pop(chat.id, None)
+        if chatbox is None:
             chatbox = ChatBox(chat)
-            self.chatboxes[chat.id] = chatbox
             self.chatbox_area.addWidget(chatbox)
-            self.chatbox_area.setCurrentWidget(chatbox)
-        else:
-            self.chatbox_area.setCurrentWidget(self.chatboxes[chat.id])
+        # most recently shown last
+        self.chatboxes[chat.id] = chatbox
+        self.chatbox_area.setCurrentWidget(chatbox)
+
+        while len(self.chatboxes) > max(env.OPEN_CHATBOXES, 1):
+            # destroying it releases its chat channel, it's built again from the state when reopened
+            stale = self.chatboxes.pop(next(iter(self.chatboxes)))
+            self.chatbox_area.removeWidget(stale)
+            stale.deleteLater()
 
 
     def sidebar_closed(self, state):
@@ -210,30 +256,28 @@ class ChatApp(QtWidgets.QMainWindow):
         self.chat_list.handle_disconnected()
 
     def on_message(self, data):
-        ActionHandler(data, self).handle()
+        # called on the connection thread, the GUI thread only applies what was decoded here
+        if env.LOG_FRAMES:
+            print("\n[RECV]", data, end="\n")
+        if self.inbound.put(self.decoder.decode(data)):
+            self.inbound_ready.emit()
+
+    def drain_inbound(self):
+        if self.inbound.drain(lambda data: ActionHandler(data, self).handle()):
+            # budget spent, let the window paint and take input before the rest
+            QTimer.singleShot(0, self.drain_inbound)
 
     def on_authenticate(self, data: dict):
         self.user = data.get("data", {}).get('user', {})
         gv.set("user", self.user)
         gv.set("is_authenticated", True)
 
-        # send waiting messages
-        for message in gv.get("waiting_messages", []):
-            data = {
-                "action": "new_message",
-                "data": {
-                    "text": message.text,
-                    "chat_id": message.chat_id,
-                    "reply_to": message.reply_to.id if message.reply_to else None,
-                    "timestamp": message.time,
-                    "local_id": message.id
-                }
-            }
-
-            gv.send_data(data)
+        # messages written while offline, and any sent but never confirmed
+        self.outbox.start()
 
     def closeEvent(self, event) -> None:
         self.conn.stop()
+        gv.close_data()
         return super().closeEvent(event)
 
 
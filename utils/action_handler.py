@@ -1,6 +1,3 @@
-from typing import Dict
-
-from chat_types import ChatType, MessageType, UserType
 from utils import gv
 
 
@@ -8,7 +5,8 @@ class ActionHandler:
     def __init__(self, data, window) -> None:
         self.window = window
         self.data = data
-        print("\n[RECV]", self.data, end="\n")
+        # built on the connection thread by PayloadDecoder
+        self.decoded = data.get("decoded")
 
     def handle(self):
         if hasattr(self, self.data.get("action")):
@@ -32,75 +30,32 @@ class ActionHandler:
             self.window.conn.send_data(data)
 
     def search_users(self):
-        results = self.data.get("data", {}).get("results")
-        results = [UserType(**user) for user in results]
-        self.window.search_results_received.emit(results)
+        self.window.search_results_received.emit(self.decoded or [])
 
     def get_messages(self):
-        results = self.data.get("data", {}).get("results")
         has_more = self.data.get("data", {}).get("has_more")
         chat_id = self.data.get("data", {}).get("chat").get("id")
-        messages = []
-        for message_data in results:
-            if message_data.get("reply_to"):
-                message_data["reply_to"] = MessageType(**message_data["reply_to"], is_mine=message_data["reply_to"]["sender"] == gv.get("user", {}).get("id"))
-
-            messages.append(MessageType(**message_data, is_mine=message_data["sender"] == gv.get("user", {}).get("id")))
-
-        existing_messages = gv.get(f"chat_messages_{chat_id}", {}).get("messages")
-        if existing_messages:
-            messages.extend(existing_messages)
-
-        gv.set(f"chat_messages_{chat_id}", {"messages": messages, "has_more": has_more})
+        gv.state.upsert_messages(chat_id, self.decoded or [], has_more=bool(has_more))
 
         # self.window.fetched_messages.emit(messages, has_more, not(is_same_chat))
 
     def get_chats(self):
-        try:
-            results = self.data.get("data", {}).get("results")
-            chats = []
-            for chat in results:
-                user = chat.get("user")
-                user = UserType(**user)
-                chat_obj = ChatType(
-                    user=user,
-                    id=chat.get("id"),
-                    last_message=chat.get("last_message"),
-                    updated_at=chat.get("updated_at"),
-                )
-                chats.append(chat_obj)
-            self.window.chats = chats
-            gv.set("chats", chats)
-            # self.window.fetched_chats.emit(chats)
-        except Exception as e:
-            print(e, "error")
+        if self.decoded is not None:
+            with gv.batch():
+                gv.state.set_chats(self.decoded)
+                self.advance_cursor(max((chat.updated_at or 0 for chat in self.decoded), default=0))
+        self.window.conn.mark_usable()
 
     def new_message(self):
-        message = self.data.get("data", {}).get("message")
-        chat_id = self.data.get("data", {}).get("message", {}).get("chat_id")
+        message = self.decoded
         local_id = self.data.get("data", {}).get("local_id")
-        if message.get("reply_to"):
-            message["reply_to"] = MessageType(**message["reply_to"], is_mine=message["reply_to"]["sender"] == gv.get("user", {}).get("id"))
-
-        if local_id:
-            waiting_messages: list = gv.get("waiting_messages", [])
-            for m in waiting_messages:
-                if m.id == local_id:
-                    waiting_messages.remove(m)
-            gv.set("waiting_messages", waiting_messages)
-
-        messages = gv.get(f"chat_messages_{chat_id}", [])
-
-        if local_id:
-            for m in messages.get("messages", []):
-                if m.id == local_id:
-                    m.id = message.get("id")
-                    m.status = message.get("status")
-                    m.local_id = local_id
-        else:
-            message = MessageType(**message, is_mine=message["sender"] == gv.get("user", {}).get("id"))
-            messages.get("messages", []).append(message)
-        gv.set(f"chat_messages_{chat_id}", messages)
+        if message is None:
+            return
+
+        with gv.batch():
+            if not local_id or not gv.state.confirm_message(message.chat_id, local_id, message.id, message.status):
+                gv.state.upsert_messages(message.chat_id, [message])
+            self.advance_cursor(message.time)
 
     def delete_message(self):
         if not self.data.get("success"):
@@ -109,12 +64,7 @@ class ActionHandler:
         message_id = self.data.get("data", {}).get("message_id")
         chat_id = self.data.get("data", {}).get("chat_id")
 
-        messages = gv.get(f"chat_messages_{chat_id}", {})
-        for message in messages.get("messages", []):
-            if message.id == message_id:
-                messages.get("messages", []).remove(message)
-
-        gv.set(f"chat_messages_{chat_id}", messages)
+        gv.state.remove_messages(chat_id, [message_id])
 
     def edit_message(self):
         if not self.data.get("success"):
@@ -124,12 +74,7 @@ class ActionHandler:
         text = self.data.get("data", {}).get("text")
         chat_id = self.data.get("data", {}).get("chat_id")
 
-        messages = gv.get(f"chat_messages_{chat_id}", {})
-        for message in messages.get("messages", []):
-            if message.id == message_id:
-                message.text = text
-
-        gv.set(f"chat_messages_{chat_id}", messages)
+        gv.state.edit_message(chat_id, message_id, text)
 
 
     def status_change(self):
@@ -137,91 +82,35 @@ class ActionHandler:
         status = self.data.get("data", {}).get("status")
         last_seen = self.data.get("data", {}).get("last_seen")
 
-        chats = gv.get("chats", [])
-        for chat in chats:
-            if chat.user and chat.user.id == user_id:
-                chat.user.is_online = status == "online"
-                chat.user.last_seen = last_seen
-
-        self.window.chats = chats
-        gv.set("chats", chats)
-        # self.window.fetched_chats.emit(chats)
+        gv.state.update_user(user_id, is_online=status == "online", last_seen=last_seen)
 
     def read_message(self):
         message_ids = self.data.get("data", {}).get("message_ids")
         chat_id = self.data.get("data", {}).get("chat_id")
 
-        messages = gv.get(f"chat_messages_{chat_id}", {})
-        for message in messages.get("messages", []):
-            if message.id in message_ids:
-                message.status = "read"
-
-        gv.set(f"chat_messages_{chat_id}", messages)
+        gv.state.mark_read(chat_id, message_ids)
 
     def get_updates(self):
-        updates = self.data.get("data", {}).get("updates", [])
-        updates_grouped = group_updates(updates)
-
-        for chat_id, updates in updates_grouped.items():
-            messages = gv.get(f"chat_messages_{chat_id}", {})
-
-            for update in updates:
-                if update.get("type") == "new_message":
-                    messages.get("messages").append(update.get("message"))
-                elif update.get("type") == "delete_message":
-                    for message in messages.get("messages"):
-                        if message.id == update.get("message_id"):
-                            messages.get("messages").remove(message)
-                elif update.get("type") == "edit_message":
-                    for message in messages.get("messages"):
-                        if message.id == update.get('message_id'):
-                            message.text = update.get("text")
-                elif update.get("type") == "read_message":
-                    for message in messages.get("messages"):
-                        if message.id in update.get('message_ids'):
-                            message.status = "read"
-
-            gv.set(f"chat_messages_{chat_id}", messages)
-
-
-def group_updates(updates: list) -> Dict[str, list]:
-    updates_grouped = {}
-    for update in updates:
-        if update.get("type") == "new_message":
-            new_message = MessageType(**update.get("body").get("message"))
-            if new_message.chat_id not in updates_grouped:
-                updates_grouped[new_message.chat_id] = []
-
-            updates_grouped[new_message.chat_id].append({"type": "new_message", "message": new_message})
-
-        elif update.get("type") == "delete_message":
-            chat_id = update.get("body", {}).get("chat_id")
-            if chat_id not in updates_grouped:
-                updates_grouped[chat_id] = []
-
-            updates_grouped[chat_id].append({
-                "type": "delete_message",
-                "message_id": update.get("body", {}).get("message_id")
-            })
-
-        elif update.get("type") == "edit_message":
-            chat_id = update.get("body", {}).get("chat_id")
-            if chat_id not in updates_grouped:
-                updates_grouped[chat_id] = []
-            updates_grouped[chat_id].append({
-                "type": "edit_message",
-                "message_id": update.get("body", {}).get("message_id"),
-                "text": update.get("body", {}).get("text")
-            })
-
-        elif update.get("type") == "read_message":
-            chat_id = update.get("body", {}).get("chat_id")
-            if chat_id not in updates_grouped:
-                updates_grouped[chat_id] = []
-
-            updates_grouped[chat_id].append({
-                "type": "read_message",
-                "message_ids": update.get("body", {}).get("message_ids")
-            })
-
-    return updates_grouped
+        # one change event per chat however many updates were missed
+        with gv.batch():
+            for chat_id, updates in (self.decoded or {}).items():
+                for update in updates:
+                    if update.get("type") == "new_message":
+                        gv.state.upsert_messages(chat_id, [update.get("message")])
+                    elif update.get("type") == "delete_message":
+                        gv.state.remove_messages(chat_id, [update.get("message_id")])
+                    elif update.get("type") == "edit_message":
+                        gv.state.edit_message(chat_id, update.get("message_id"), update.get("text"))
+                    elif update.get("type") == "read_message":
+                        gv.state.mark_read(chat_id, update.get("message_ids"))
+            self.advance_cursor(max(
+                (update["message"].time for updates in (self.decoded or {}).values() for update in updates if update.get("type") == "new_message"),
+                default=0,
+            ))
+        self.window.conn.mark_usable()
+
+    @staticmethod
+    def advance_cursor(time):
+        """Remember the server time of the newest event applied, a reconnect asks for updates after it"""
+        if time and time > (gv.get("resume_cursor") or 0):
+            gv.set("resume_cursor", time)
@@ -0,0 +1,105 @@
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from chat_types import ChatType
+
+
+def _key(chat: ChatType) -> Tuple[float, str]:
+    # newest activity first, ties broken by id so every chat has one place
+    return -(chat.updated_at or 0), chat.id
+
+
+class ChatIndex:
+    """
+    Chats by id, by the user they are with, and in recency order.
+
+    The order is a list kept sorted by `updated_at` (newest first): moving a
+    chat to its new place on activity is two bisects and two list shifts, no
+    resorting, and the caller is told exactly where it moved from and to.
+    """
+
+    def __init__(self, chats: Iterable[ChatType] = ()):
+        self.by_id: Dict[str, ChatType] = {}
+        self._by_user: Dict[str, Set[str]] = {}
+        self._keys: Dict[str, Tuple[float, str]] = {}
+        self._order_keys: List[Tuple[float, str]] = []
+        self._order: List[ChatType] = []
+        self.reset(chats)
+
+    def __len__(self):
+        return len(self._order)
+
+    def __iter__(self) -> Iterator[ChatType]:
+        return iter(self._order)
+
+    def __contains__(self, chat_id):
+        return chat_id in self.by_id
+
+    def reset(self, chats: Iterable[ChatType]):
+        # a chat listed twice keeps its last entry, like add() does
+        self.by_id = {chat.id: chat for chat in chats}
+        self._order = sorted(self.by_id.values(), key=_key)
+        self._order_keys = [_key(chat) for chat in self._order]
+        self._keys = {chat.id: key for chat, key in zip(self._order, self._order_keys)}
+        self._by_user = {}
+        for chat in self._order:
+            if chat.user:
+                self._by_user.setdefault(chat.user.id, set()).add(chat.id)
+
+    def ordered(self) -> List[ChatType]:
+        return list(self._order)
+
+    def get(self, chat_id: str) -> Optional[ChatType]:
+        return self.by_id.get(chat_id)
+
+    def position(self, chat_id: str) -> int:
+        return bisect_left(self._order_keys, self._keys[chat_id])
+
+    def chats_for_user(self, user_id: str) -> List[ChatType]:
+        return [self.by_id[chat_id] for chat_id in self._by_user.get(user_id, ())]
+
+    def neighbour(self, chat_id: str, step: int) -> Optional[ChatType]:
+        """Chat `step` places after (or before) `chat_id` in recency order, wrapping around"""
+        if chat_id not in self.by_id:
+            return self._order[0] if self._order else None
+        return self._order[(self.position(chat_id) + step) % len(self._order)]
+
+    def add(self, chat: ChatType) -> int:
+        if chat.id in self.by_id:
+            self.remove(chat.id)
+        key = _key(chat)
+        position = bisect_left(self._order_keys, key)
+        self._order_keys.insert(position, key)
+        self._order.insert(position, chat)
+        self._keys[chat.id] = key
+        self.by_id[chat.id] = chat
+        if chat.user:
+            self._by_user.setdefault(chat.user.id, set()).add(chat.id)
+        return position
+
+    def remove(self, chat_id: str) -> Optional[ChatType]:
+        chat = self.by_id.pop(chat_id, None)
+        if chat is None:
+            return None
+        position = bisect_left(self._order_keys, self._keys.pop(chat_id))
+        del self._order_keys[position]
+        del self._order[position]
+        if chat.user and chat.user.id in self._by_user:
+            self._by_user[chat.user.id].discard(chat_id)
+        return chat
+
+    def touch(self, chat_id: str, updated_at: float) -> Optional[Tuple[int, int]]:
+        """Record activity in a chat, returns (from, to) positions if it moved"""
+        chat = self.by_id.get(chat_id)
+        if chat is None:
+            return None
+        before = self.position(chat_id)
+        del self._order_keys[before]
+        del self._order[before]
+
+        chat.updated_at = updated_at
+        key = self._keys[chat_id] = _key(chat)
+        after = bisect_left(self._order_keys, key)
+        self._order_keys.insert(after, key)
+        self._order.insert(after, chat)
+        return (before, after) if before != after else None
@@ -0,0 +1,312 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from chat_types import MessageType
+
+STATUSES = ["sending", "sent", "read", "delivered"]
+READ = STATUSES.index("read")
+
+NO_REPLY = -1
+# replied message isn't in the collection, kept as an object in _outside_replies
+OUTSIDE_REPLY = -2
+
+
+class ColumnarMessageCollection:
+    """
+    MessageCollection for very large chats, one array per field instead of an
+    object per message.
+
+    Every message gets a slot when it is added and keeps it: time, status code,
+    sender and chat (indexes into a string table), is_mine and the replied
+    message's slot live in `array`s indexed by slot, texts share one buffer.
+    `_order` lists the live slots sorted by time, so inserting moves machine
+    words instead of objects. MessageType objects are only built for the rows
+    someone reads; they are copies, changes go through set_text(),
+    set_status(), mark_read() and rename().
+    """
+
+    def __init__(self, messages: Iterable[MessageType] = ()):
+        self._times = array("d")
+        self._statuses = array("l")
+        self._senders = array("l")
+        self._chats = array("l")
+        self._is_mine = array("b")
+        self._replies = array("l")
+        self._text_offsets = array("q")
+        self._text_lengths = array("l")
+        self._text = bytearray()
+        self._dead_text = 0
+        self._ids: List[str] = []
+        self._local_ids: Dict[int, str] = {}
+        self._outside_replies: Dict[int, MessageType] = {}
+
+        self._strings: List[Optional[str]] = [None]
+        self._string_ids: Dict[Optional[str], int] = {None: 0}
+        self._status_names = list(STATUSES)
+        self._status_codes = {status: code for code, status in enumerate(STATUSES)}
+
+        self._slots: Dict[str, int] = {}
+        self._aliases: Dict[str, str] = {}
+        self._order = array("l")
+        self.extend(messages)
+
+    def __len__(self):
+        return len(self._order)
+
+    def __iter__(self) -> Iterator[MessageType]:
+        for slot in self._order:
+            yield self._view(slot)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._view(slot) for slot in self._order[index]]
+        return self._view(self._order[index])
+
+    def __contains__(self, message_id):
+        return self._slot(message_id) is not None
+
+    def __repr__(self):
+        return f"ColumnarMessageCollection({len(self._order)} messages)"
+
+    @property
+    def first(self) -> Optional[MessageType]:
+        return self._view(self._order[0]) if self._order else None
+
+    @property
+    def last(self) -> Optional[MessageType]:
+        return self._view(self._order[-1]) if self._order else None
+
+    def get(self, message_id: str) -> Optional[MessageType]:
+        slot = self._slot(message_id)
+        return self._view(slot) if slot is not None else None
+
+    def index(self, message_id: str) -> int:
+        slot = self._slot(message_id)
+        if slot is None:
+            raise KeyError(message_id)
+        return self._position(slot)
+
+    def add(self, message: MessageType) -> bool:
+        slot = self._slots.get(message.id)
+        if slot is None:
+            slot = self._new_slot(message)
+            self._insert(slot)
+            self._link_reply(slot, message)
+            return True
+
+        moved = self._times[slot] != message.time
+        if moved:
+            del self._order[self._position(slot)]
+        self._dead_text += self._text_lengths[slot]
+        self._write(slot, message)
+        self._link_reply(slot, message)
+        if moved:
+            self._insert(slot)
+        # after the slot is back in _order, compaction keeps live slots only
+        self._maybe_compact_text()
+        return False
+
+    def extend(self, messages: Iterable[MessageType]) -> List[MessageType]:
+        messages = sorted(messages, key=lambda message: message.time)
+        if messages and self._order and not any(message.id in self._slots for message in messages):
+            if messages[-1].time < self._times[self._order[0]]:
+                self.prepend(messages)
+                return messages
+            if messages[0].time >= self._times[self._order[-1]]:
+                self._order.extend(self._new_slots(messages))
+                return messages
+        return [message for message in messages if self.add(message)]
+
+    def prepend(self, messages: List[MessageType]):
+        messages = [message for message in sorted(messages, key=lambda message: message.time) if message.id not in self._slots]
+        if self._order and messages and messages[-1].time > self._times[self._order[0]]:
+            for message in messages:
+                self.add(message)
+            return
+        self._order[0:0] = array("l", self._new_slots(messages))
+
+    def remove(self, message_id: str) -> Optional[MessageType]:
+        slot = self._slot(message_id)
+        if slot is None:
+            return None
+        message = self._view(slot)
+        del self._order[self._position(slot)]
+        # the slot stays allocated, replies may still point at it
+        del self._slots[self._ids[slot]]
+        local_id = self._local_ids.get(slot)
+        if local_id and self._aliases.get(local_id) == self._ids[slot]:
+            del self._aliases[local_id]
+        self._dead_text += self._text_lengths[slot]
+        self._maybe_compact_text()
+        return message
+
+    def rename(self, old_id: str, new_id: str) -> Optional[MessageType]:
+        """Like MessageCollection.rename, objects handed out before keep their id, use the returned one"""
+        slot = self._slots.pop(old_id, None)
+        if slot is None:
+            return None
+        self._ids[slot] = new_id
+        self._local_ids.setdefault(slot, old_id)
+        self._slots[new_id] = slot
+        if old_id != new_id:
+            self._aliases[old_id] = new_id
+        return self._view(slot)
+
+    def set_text(self, message_id: str, text: str) -> Optional[MessageType]:
+        slot = self._slot(message_id)
+        if slot is None:
+            return None
+        self._dead_text += self._text_lengths[slot]
+        self._set_text(slot, text)
+        self._maybe_compact_text()
+        return self._view(slot)
+
+    def set_status(self, message_id: str, status: str) -> Optional[MessageType]:
+        slot = self._slot(message_id)
+        if slot is None:
+            return None
+        self._statuses[slot] = self._status_code(status)
+        return self._view(slot)
+
+    def mark_read(self, message_ids: Iterable[str]) -> List[MessageType]:
+        """Mark messages read, returns the ones that weren't; touches only the status column"""
+        statuses = self._statuses
+        changed = []
+        for slot in dict.fromkeys(map(self._slot, message_ids)):
+            if slot is not None and statuses[slot] != READ:
+                statuses[slot] = READ
+                changed.append(slot)
+        return [self._view(slot) for slot in changed]
+
+    def before(self, time: Optional[float], limit: int) -> List[MessageType]:
+        end = len(self._order) if time is None else bisect_left(self._order, time, key=self._times.__getitem__)
+        return [self._view(slot) for slot in self._order[max(end - limit, 0):end]]
+
+    def between(self, start: float, end: float) -> List[MessageType]:
+        key = self._times.__getitem__
+        return [self._view(slot) for slot in self._order[bisect_left(self._order, start, key=key):bisect_left(self._order, end, key=key)]]
+
+    def newest(self, count: int) -> List[MessageType]:
+        return [self._view(slot) for slot in self._order[max(len(self._order) - count, 0):]] if count else []
+
+    def _slot(self, message_id: str) -> Optional[int]:
+        slot = self._slots.get(message_id)
+        if slot is None and message_id in self._aliases:
+            slot = self._slots.get(self._aliases[message_id])
+        return slot
+
+    def _position(self, slot: int) -> int:
+        position = bisect_left(self._order, self._times[slot], key=self._times.__getitem__)
+        while self._order[position] != slot:
+            position += 1
+        return position
+
+    def _insert(self, slot: int):
+        if not self._order or self._times[self._order[-1]] <= self._times[slot]:
+            self._order.append(slot)
+        else:
+            self._order.insert(bisect_right(self._order, self._times[slot], key=self._times.__getitem__), slot)
+
+    def _new_slots(self, messages: List[MessageType]) -> List[int]:
+        slots = [self._new_slot(message) for message in messages]
+        for slot, message in zip(slots, messages):
+            self._link_reply(slot, message)
+        return slots
+
+    def _new_slot(self, message: MessageType) -> int:
+        slot = len(self._ids)
+        self._ids.append(message.id)
+        self._times.append(0.0)
+        self._statuses.append(0)
+        self._senders.append(0)
+        self._chats.append(0)
+        self._is_mine.append(0)
+        self._replies.append(NO_REPLY)
+        self._text_offsets.append(0)
+        self._text_lengths.append(0)
+        self._write(slot, message)
+        self._slots[message.id] = slot
+        return slot
+
+    def _write(self, slot: int, message: MessageType):
+        self._times[slot] = message.time
+        self._statuses[slot] = self._status_code(message.status)
+        self._senders[slot] = self._string(message.sender)
+        self._chats[slot] = self._string(message.chat_id)
+        self._is_mine[slot] = bool(message.is_mine)
+        self._set_text(slot, message.text or "")
+        if message.local_id and message.local_id != message.id:
+            self._local_ids[slot] = message.local_id
+            self._aliases[message.local_id] = message.id
+
+    def _link_reply(self, slot: int, message: MessageType):
+        self._outside_replies.pop(slot, None)
+        reply_to = message.reply_to
+        if reply_to is None:
+            self._replies[slot] = NO_REPLY
+        elif reply_to.id in self._slots:
+            self._replies[slot] = self._slots[reply_to.id]
+        else:
+            self._replies[slot] = OUTSIDE_REPLY
+            self._outside_replies[slot] = reply_to
+
+    def _set_text(self, slot: int, text: str):
+        encoded = text.encode()
+        self._text_offsets[slot] = len(self._text)
+        self._text_lengths[slot] = len(encoded)
+        self._text += encoded
+
+    def _maybe_compact_text(self):
+        if self._dead_text > len(self._text) // 2:
+            self._compact_text()
+
+    def _compact_text(self):
+        """Drop texts of removed messages and old versions of edited ones"""
+        keep = set(self._order)
+        keep.update(slot for slot in self._replies if slot >= 0)
+        text = bytearray()
+        for slot in range(len(self._ids)):
+            offset, length = self._text_offsets[slot], self._text_lengths[slot]
+            self._text_offsets[slot] = len(text)
+            if slot in keep:
+                text += self._text[offset:offset + length]
+            else:
+                self._text_lengths[slot] = 0
+        self._text = text
+        self._dead_text = 0
+
+    def _string(self, value: Optional[str]) -> int:
+        index = self._string_ids.get(value)
+        if index is None:
+            index = self._string_ids[value] = len(self._strings)
+            self._strings.append(value)
+        return index
+
+    def _status_code(self, status: str) -> int:
+        code = self._status_codes.get(status)
+        if code is None:
+            code = self._status_codes[status] = len(self._status_names)
+            self._status_names.append(status)
+        return code
+
+    def _view(self, slot: int, with_reply: bool = True) -> MessageType:
+        reply_slot = self._replies[slot]
+        reply_to = None
+        if reply_slot >= 0 and with_reply:
+            reply_to = self._view(reply_slot, with_reply=False)
+        elif reply_slot == OUTSIDE_REPLY:
+            reply_to = self._outside_replies[slot]
+
+        offset = self._text_offsets[slot]
+        return MessageType(
+            id=self._ids[slot],
+            text=self._text[offset:offset + self._text_lengths[slot]].decode(),
+            sender=self._strings[self._senders[slot]],
+            time=self._times[slot],
+            status=self._status_names[self._statuses[slot]],
+            is_mine=bool(self._is_mine[slot]),
+            chat_id=self._strings[self._chats[slot]],
+            reply_to=reply_to,
+            local_id=self._local_ids.get(slot),
+        )
@@ -1,26 +1,50 @@
-import json
 import os
-from copy import deepcopy
+import shutil
+from concurrent.futures import Future
 from dataclasses import asdict
 from datetime import datetime
-from typing import Optional
+from threading import RLock
+from typing import Dict, List, Optional, Union
 
-from PySide6.QtCore import QObject, Signal
+from PySide6.QtCore import QObject, Qt, Signal
 
+import env
 from chat_types import ChatType, MessageType, UserType
+from lib import codec
+from lib.archive import MessageArchive
 from lib.conn import Conn
-
-data = {}
+from lib.journal import JournalStore
+from lib.persist_worker import PersistWorker
+from lib.shard_store import ShardStore
+from lib.sqlite_store import SqliteStore
+from utils.columnar_collection import ColumnarMessageCollection
+from utils.message_cache import MessageCache
+from utils.state import Change, State
+
+codec.use(env.JSON_BACKEND)
+state = State()
 data_loaded = False
 _conn: Optional[Conn] = None
+_store: Optional[Union[JournalStore, SqliteStore, ShardStore]] = None
+_worker: Optional[PersistWorker] = None
+# raw chat_messages_<id> values not decoded yet
+_unloaded: Dict[str, dict] = {}
+_archives: Dict[str, MessageArchive] = {}
+message_cache = MessageCache(env.MESSAGE_CACHE_BUDGET, env.CHAT_MESSAGE_CAP)
+_unloaded_lock = RLock()
+_selected_chat_id: Optional[str] = None
 instance = 0
 DATA_BLACKLIST = ["is_authenticated"]
 
 class SignalManager(QObject):
     chats_changed = Signal(list)
     selected_chat_changed = Signal(ChatType)
-    messages_changed = Signal(dict, str)
+    # a chat's last message, time or user changed
+    chat_changed = Signal(ChatType)
+    # chat id, from, to: a chat moved in the recency order of state.chats
+    chat_moved = Signal(str, int, int)
     sidebar_opened_changed = Signal(bool)
+    user_changed = Signal(UserType)
 
     _instance = None
 
@@ -39,32 +63,311 @@ class SignalManager(QObject):
 signal_manager = SignalManager()
 
 
+class ChatChannel(QObject):
+    """Message signals of a single chat, only the widgets showing that chat are connected"""
+
+    # the whole history was replaced
+    messages_changed = Signal(dict)
+    message_added = Signal(MessageType)
+    # id the message had before (local id of a confirmed message), message
+    message_updated = Signal(str, MessageType)
+    message_removed = Signal(str)
+    # messages older than everything the chat held, oldest first
+    messages_prepended = Signal(list)
+    has_more_changed = Signal(bool)
+
+    def __init__(self, chat_id: str):
+        super().__init__()
+        self.chat_id = chat_id
+        self.subscribers = 0
+
+    def release(self):
+        self.subscribers -= 1
+        if self.subscribers <= 0 and _channels.get(self.chat_id) is self:
+            _channels.pop(self.chat_id)
+            self.deleteLater()
+
+
+_channels: Dict[str, ChatChannel] = {}
+
+
+def chat_channel(chat_id: str, owner: QObject) -> ChatChannel:
+    """Signals of one chat for `owner`, released when the owner is destroyed or calls release()"""
+    channel = _channels.get(chat_id)
+    if channel is None:
+        channel = _channels[chat_id] = ChatChannel(chat_id)
+    channel.subscribers += 1
+    owner.destroyed.connect(channel.release)
+    return channel
+
+
+class _TickFlusher(QObject):
+    """Dispatches the state changes of one event loop iteration together, from the GUI thread"""
+
+    requested = Signal()
+
+    def __init__(self):
+        super().__init__()
+        # queued: runs once control is back in the event loop, whichever thread asked
+        self.requested.connect(self.flush, Qt.ConnectionType.QueuedConnection)
+
+    def flush(self):
+        state.flush()
+
+
+def batch():
+    """
+    Merge every mutation made inside `with gv.batch():` into one change,
+    signals and persistence run once when the outermost batch ends.
+    """
+    return state.transaction()
+
+
 def set(key, value):
-    global data
-    data[key] = value
+    """Replace a whole value by its old gv key, prefer the typed mutation methods on `state`"""
+    if key == "chats":
+        state.set_chats(value)
+    elif key == "waiting_messages":
+        state.set_outbox(value)
+    elif key.startswith("chat_messages_"):
+        state.replace_history(key.split("chat_messages_")[1], value)
+    else:
+        state.set_session(key, value)
 
+
+def get(key, default=None):
     if key == "chats":
-        signal_manager.chats_changed.emit(value)
-    elif key == "selected_chat":
-        signal_manager.selected_chat_changed.emit(value)
+        return state.chats
+    elif key == "waiting_messages":
+        return state.outbox
     elif key.startswith("chat_messages_"):
         chat_id = key.split("chat_messages_")[1]
-        signal_manager.messages_changed.emit(value, chat_id)
-    elif key == "sidebar_opened":
-        signal_manager.sidebar_opened_changed.emit(value)
-    elif key == "is_authenticated" and value:
-        if data_loaded and data.get("last_updated_time"):
-            data_to_send = {'action': "get_updates", "data": {"last_time": data.get("last_updated_time")}}
+        if chat_id in state.histories:
+            message_cache.hit(chat_id)
         else:
-            data_to_send = {'action': "get_chats", "data": {}}
-        send_data(data_to_send)
+            message_cache.miss(chat_id)
+            _materialize(chat_id)
+        return state.histories.get(chat_id, default)
+    return state.session.get(key, default)
+
+
+def _on_chats_change(change: Change):
+    signal_manager.chats_changed.emit(state.chats)
+
+
+def _on_chat_change(change: Change):
+    if change.chats:
+        # the whole list was replaced, chats_changed already carries the new order
         return
+    for chat_id, before, after in change.moved:
+        signal_manager.chat_moved.emit(chat_id, before, after)
+    for chat_id in change.chat_ids:
+        chat = state.chat_index.get(chat_id)
+        if chat is not None:
+            signal_manager.chat_changed.emit(chat)
+
+
+def _on_user_change(change: Change):
+    for user_id in change.user_ids:
+        signal_manager.user_changed.emit(state.users[user_id])
+
+
+def _on_session_change(change: Change):
+    global _selected_chat_id
+    for key in change.session:
+        value = state.session.get(key)
+        if key == "selected_chat":
+            signal_manager.selected_chat_changed.emit(value)
+            previous_id, _selected_chat_id = _selected_chat_id, value.id if value else None
+            if previous_id and previous_id != _selected_chat_id:
+                # the chat the user left may have grown past the cap while it was open
+                _enforce_cache_budget(previous_id)
+        elif key == "sidebar_opened":
+            signal_manager.sidebar_opened_changed.emit(value)
+        elif key == "is_authenticated" and value:
+            # resume from the newest event already applied, not from scratch
+            cursor = state.session.get("resume_cursor") or state.session.get("last_updated_time")
+            if data_loaded and cursor:
+                data_to_send = {'action': "get_updates", "data": {"last_time": cursor}}
+            else:
+                data_to_send = {'action': "get_chats", "data": {}}
+            send_data(data_to_send)
+
+
+def _on_messages_change(change: Change):
+    for chat_id, messages_change in change.messages.items():
+        history = state.histories.get(chat_id)
+        if history is None:
+            continue
+        # only a ChatBox showing this chat has a channel for it
+        channel = _channels.get(chat_id)
+        if channel is not None and messages_change.replaced:
+            channel.messages_changed.emit(history)
+        elif channel is not None:
+            _emit_message_deltas(channel, messages_change, history)
+        message_cache.update(chat_id, len(history.get("messages", [])))
+        _enforce_cache_budget(chat_id)
+
+
+def _emit_message_deltas(channel: ChatChannel, messages_change, history):
+    renamed_from = {local_id for local_id in messages_change.renamed.values()}
+    for message_id in messages_change.removed:
+        if message_id not in renamed_from:
+            channel.message_removed.emit(message_id)
+    if messages_change.prepended:
+        channel.messages_prepended.emit(sorted(messages_change.prepended.values(), key=lambda message: message.time))
+    for message in sorted(messages_change.added.values(), key=lambda message: message.time):
+        channel.message_added.emit(message)
+    for message_id, message in messages_change.upserted.items():
+        if message_id not in messages_change.added and message_id not in messages_change.prepended:
+            channel.message_updated.emit(messages_change.renamed.get(message_id, message_id), message)
+    if messages_change.has_more:
+        channel.has_more_changed.emit(bool(history.get("has_more")))
+
+
+def _persist(change: Change):
+    """Tell the persistence worker exactly which entities changed"""
+    worker = _get_worker()
+    if change.chats or change.chat_ids or change.user_ids:
+        worker.mark_key("chats")
+    if change.outbox:
+        worker.mark_key("waiting_messages")
+    for key in change.session:
+        save_key(key)
+    for chat_id, messages_change in change.messages.items():
+        if messages_change.removed:
+            _get_archive(chat_id).remove(messages_change.removed)
+        if messages_change.replaced:
+            worker.mark_key(f"chat_messages_{chat_id}")
+            continue
+        # pages read back from the archive are already stored, anything else in the same change isn't
+        transient = messages_change.transient_ids
+        upserted = [message for message_id, message in messages_change.upserted.items() if message_id not in transient]
+        if upserted or messages_change.removed or (messages_change.has_more and not transient):
+            history = state.histories.get(chat_id, {})
+            worker.mark_messages(chat_id, upserted, messages_change.removed, bool(history.get("has_more")))
+
+
+state.history_loader = lambda chat_id: _materialize(chat_id)
+if env.COALESCE_UPDATES:
+    _tick_flusher = _TickFlusher()
+    state.defer = _tick_flusher.requested.emit
+if env.HISTORY_BACKEND == "columnar":
+    state.collection_factory = ColumnarMessageCollection
+state.subscribe(_on_chats_change, "chats")
+state.subscribe(_on_chat_change, "chat")
+state.subscribe(_on_user_change, "user")
+state.subscribe(_on_session_change, "session")
+state.subscribe(_on_messages_change, "messages")
+state.subscribe(_persist)
+
+
+def load_older_messages(chat_id, before: float, limit: int = 50) -> List[MessageType]:
+    """Messages older than `before` that are persisted locally but not loaded into memory"""
+    rows = _get_archive(chat_id).page_before(before, limit)
+    if not rows:
+        store = _get_store()
+        rows = store.query_messages(chat_id, before, limit) if hasattr(store, "query_messages") else []
+    return list(decode_value(f"chat_messages_{chat_id}", {"messages": rows})["messages"])
+
+
+def archive_history(chat_id, keep: Optional[int] = None):
+    """Move everything but the newest `keep` (HISTORY_WINDOW) messages of a chat to its archive"""
+    with _unloaded_lock:
+        key = f"chat_messages_{chat_id}"
+        value = state.histories.get(chat_id)
+        keep = env.HISTORY_WINDOW if keep is None else keep
+        if not value or len(value.get("messages", [])) <= keep:
+            return
 
-    save_data(data)
+        messages = value["messages"]
+        archived = messages[:len(messages) - keep]
+        value["messages"] = state.new_collection(messages.newest(keep))
+        value["has_more"] = True
+        message_cache.trimmed += len(archived)
+        message_cache.update(chat_id, len(value["messages"]))
+        if _keeps_rows():
+            # the store pages older messages itself, they're written now so paging finds them right away.
+            # marking them too puts them back should a pending rewrite of the key, which only sees the
+            # window now, delete them
+            _get_store().upsert_messages(chat_id, [message.to_dict() for message in archived], True)
+            _get_worker().mark_messages(chat_id, archived, (), True)
+            return
+        _get_archive(chat_id).append([message.to_dict() for message in archived])
+        # the store keeps the window only, older pages come from the archive
+        save_key(key)
 
 
-def get(key, default=None):
-    return data.get(key, default)
+def evict_history(chat_id):
+    """Drop a chat's history from memory, it is materialized again from the archive on next access"""
+    with _unloaded_lock:
+        if chat_id not in state.histories:
+            return
+        archive_history(chat_id, keep=0)
+        state.drop_history(chat_id)
+        if _keeps_rows():
+            # no messages, _materialize() asks the store for them
+            _unloaded[chat_id] = {"has_more": True}
+        else:
+            # everything is in the archive now, this stub is what the store keeps so a restart still finds it
+            _unloaded[chat_id] = {"messages": [], "has_more": True}
+        message_cache.forget(chat_id)
+        message_cache.evictions += 1
+
+
+def cache_stats() -> dict:
+    return message_cache.stats()
+
+
+def _enforce_cache_budget(chat_id):
+    # the open chat keeps whatever the user scrolled back to
+    selected_chat = state.session.get("selected_chat")
+    protected = [selected_chat.id] if selected_chat else []
+
+    if chat_id not in protected and message_cache.over_cap(chat_id):
+        archive_history(chat_id)
+    for victim in message_cache.victims(protected):
+        evict_history(victim)
+
+
+def _get_archive(chat_id) -> MessageArchive:
+    if chat_id not in _archives:
+        _archives[chat_id] = MessageArchive(f"data{instance}_archive", chat_id)
+    return _archives[chat_id]
+
+
+def _materialize(chat_id):
+    """Decode the newest HISTORY_WINDOW messages of a chat that was left raw or evicted"""
+    with _unloaded_lock:
+        key = f"chat_messages_{chat_id}"
+        if chat_id in state.histories or chat_id not in _unloaded:
+            return
+        raw = _unloaded.pop(chat_id)
+        window = env.HISTORY_WINDOW
+
+        rows = raw.get("messages")
+        stored_in_snapshot = rows is not None
+        if rows is None:
+            # store keeps messages outside of the loaded state, ask for the newest window only
+            store = _get_store()
+            rows = store.query_messages(chat_id, None, window + 1) if hasattr(store, "query_messages") else []
+        if len(rows) <= window:
+            # top up from the archive, it holds everything older than what the store kept
+            rows = _get_archive(chat_id).page_before(rows[0].get("time") if rows else None, window + 1 - len(rows)) + rows
+
+        if not rows:
+            # nothing cached locally, leave it to ChatBox to fetch from the server
+            return
+
+        has_more = bool(raw.get("has_more")) or len(rows) > window
+        older = rows[:-window]
+        rows = rows[-window:]
+        state.load_history(chat_id, decode_value(key, {"messages": rows, "has_more": has_more}))
+        message_cache.update(chat_id, len(rows))
+
+        if stored_in_snapshot and older:
+            _get_archive(chat_id).append(older)
+            save_key(key)
 
 
 def set_conn(conn_object):
@@ -74,82 +377,185 @@ def set_conn(conn_object):
 def get_conn():
     return _conn
 
-def send_data(data: dict):
+def send_data(data: dict, lane: Optional[str] = None):
     if _conn:
-        _conn.send_data(data)
+        _conn.send_data(data, lane)
     else:
         print("connection not ready yet")
 
 
-def save_data(data: dict):
-    with open(f"data{instance}.json", "w") as f:
-        data_to_save = deepcopy(data)
-        for key, value in data.items():
-            if key in DATA_BLACKLIST:
-                data_to_save.pop(key)
+def request(action: str, data: Optional[dict] = None, timeout: float = 10.0) -> Future:
+    """Conn.request(), failures are reported here so callers only handle answers"""
+    if _conn:
+        future = _conn.request(action, data, timeout)
+    else:
+        future = Future()
+        future.set_exception(ConnectionError("connection not ready yet"))
+    future.add_done_callback(_report_request_failure)
+    return future
 
-        data_to_save["chats"] = [asdict(item) for item in data_to_save.get("chats", [])]
-        data_to_save["selected_chat"] = asdict(data_to_save["selected_chat"]) if data_to_save.get("selected_chat") else {}
-        data_to_save["waiting_messages"] = [asdict(item) for item in data_to_save.get("waiting_messages", [])]
-        for key, value in data_to_save.items():
-            if key.startswith("chat_messages_"):
-                data_to_save[key]["messages"] = [asdict(item) for item in value.get('messages', [])]
-        data_to_save["last_updated_time"] = datetime.now().timestamp()
 
-        f.write(json.dumps(data_to_save))
+def _report_request_failure(future: Future):
+    if not future.cancelled() and future.exception() is not None:
+        print("[REQUEST FAILED]", future.exception())
 
 
-def load_data():
-    global data, data_loaded
-
-    if not os.path.exists(f"data{instance}.json"):
-        with open(f"data{instance}.json", "w") as f:
-            f.write("{}")
-
-    with open(f"data{instance}.json", "r") as file:
-        try:
-            loaded_data = json.load(file)
-        except Exception as e:
-            print(e, "error when recovering")
-            loaded_data = {}
-            return
+def _get_store() -> Union[JournalStore, SqliteStore, ShardStore]:
+    global _store
+    if _store is None:
+        if env.STORAGE_ENGINE == "sqlite":
+            _store = SqliteStore(f"data{instance}")
+        elif env.STORAGE_ENGINE == "shards":
+            _store = ShardStore(f"data{instance}")
+        else:
+            _store = JournalStore(f"data{instance}", snapshot_format=env.SNAPSHOT_FORMAT)
+    return _store
 
-    loaded_data["chats"] = [
-        ChatType(**{k: v for k, v in item.items() if k != "user"}, user=UserType(**item.get("user", {})))
-        for item in loaded_data.get("chats", [])
-    ]
-    if loaded_data.get("selected_chat"):
-        user_data = loaded_data["selected_chat"].pop("user", {})
-        loaded_data["selected_chat"] = ChatType(**loaded_data["selected_chat"], user=UserType(**user_data))
-    if loaded_data.get("waiting_messages"):
-        loaded_data["waiting_messages"] = [MessageType(**item) for item in loaded_data.get("waiting_messages", [])]
-    for key, value in loaded_data.items():
-        if key.startswith("chat_messages_"):
-            messages = []
-            for item in value.get('messages', []):
-                reply_to = None
-                if item.get("reply_to"):
-                    reply_to = MessageType(**item.get("reply_to"))
-                item.pop("reply_to")
-                message = MessageType(**item, reply_to=reply_to)
-                messages.append(message)
 
-            loaded_data[key]["messages"] = messages
+def _keeps_rows() -> bool:
+    """Whether the store keeps messages as rows it can page through, rather than one value per chat"""
+    return hasattr(_get_store(), "query_messages")
+
+
+def _get_worker() -> PersistWorker:
+    global _worker
+    if _worker is None:
+        # values are encoded under the state lock, the GUI thread keeps changing them
+        _worker = PersistWorker(
+            _get_store(), _snapshot_key, MessageType.to_dict, interval=env.PERSIST_INTERVAL_MS / 1000, lock=state._lock
+        )
+        _worker.start()
+    return _worker
+
+
+def _snapshot_key(key):
+    if key == "chats":
+        return True, encode_value(key, state.chats)
+    elif key == "waiting_messages":
+        return True, encode_value(key, state.outbox)
+    elif key.startswith("chat_messages_"):
+        chat_id = key.split("chat_messages_")[1]
+        if chat_id not in state.histories:
+            raw = _unloaded.get(chat_id)
+            if raw is not None and raw.get("messages") is not None:
+                # evicted, or never decoded
+                return True, raw
+            return False, None
+        return True, encode_value(key, state.histories[chat_id])
+    if key not in state.session:
+        return False, None
+    return True, encode_value(key, state.session[key])
+
+
+def persistence_stats() -> dict:
+    return _worker.stats() if _worker else {}
+
+
+def encode_value(key, value):
+    if key == "chats":
+        return [asdict(item) for item in value or []]
+    elif key == "waiting_messages":
+        return [item.to_dict() for item in value or []]
+    elif key == "selected_chat":
+        return asdict(value) if value else {}
+    elif key.startswith("chat_messages_"):
+        encoded = dict(value or {})
+        encoded["messages"] = [item.to_dict() for item in encoded.get("messages", [])]
+        return encoded
+    return value
+
+
+def decode_value(key, value):
+    if key == "chats":
+        return [
+            ChatType(**{k: v for k, v in item.items() if k != "user"}, user=UserType(**item.get("user", {})))
+            for item in value or []
+        ]
+    elif key == "selected_chat":
+        if not value:
+            return value
+        value = dict(value)
+        user_data = value.pop("user", {})
+        return ChatType(**value, user=UserType(**user_data))
+    elif key == "waiting_messages":
+        return [MessageType(**item) for item in value or []]
+    elif key.startswith("chat_messages_"):
+        messages = []
+        for item in value.get('messages', []):
+            reply_to = None
+            if item.get("reply_to"):
+                reply_to = MessageType(**item.get("reply_to"))
+            item.pop("reply_to", None)
+            message = MessageType(**item, reply_to=reply_to)
+            messages.append(message)
+        value["messages"] = state.new_collection(messages)
+    return value
+
+
+def save_key(key):
+    if key in DATA_BLACKLIST:
+        return
+    _get_worker().mark_key(key)
+
+
+def save_data():
+    _get_store().write_snapshot(_build_snapshot())
+
+
+def export_json(path: str):
+    """Write the whole cache as a single JSON document, whatever the storage engine"""
+    with open(path, "wb") as f:
+        f.write(codec.dumps(_build_snapshot()))
 
-    for key, value in loaded_data.items():
-        if value:
-            data[key] = value
-    data_loaded = True
 
-    signal_manager.chats_changed.emit(data.get("chats", []))
-    if data.get("selected_chat"):
-        signal_manager.selected_chat_changed.emit(data.get("selected_chat"))
-    if data.get("sidebar_opened"):
-        signal_manager.sidebar_opened_changed.emit(data.get("sidebar_opened"))
+def _build_snapshot() -> dict:
+    keys = ["chats", "waiting_messages", *state.session.keys()]
+    keys.extend(f"chat_messages_{chat_id}" for chat_id in state.histories)
 
+    data_to_save = {}
+    for key in keys:
+        if key not in DATA_BLACKLIST:
+            data_to_save[key] = _snapshot_key(key)[1]
+    for chat_id, raw in _unloaded.items():
+        if raw.get("messages") is not None:
+            data_to_save[f"chat_messages_{chat_id}"] = raw
+    data_to_save["last_updated_time"] = datetime.now().timestamp()
+    return data_to_save
+
+
+def load_data():
+    global data_loaded, _selected_chat_id
+
+    try:
+        loaded_data = _get_store().load()
+    except Exception as e:
+        print(e, "error when recovering")
+        return
+
+    session = {}
     for key, value in loaded_data.items():
         if key.startswith("chat_messages_"):
-            signal_manager.messages_changed.emit(data[key], key.split("chat_messages_")[1])
+            # histories are decoded on first access, see _materialize()
+            _unloaded[key.split("chat_messages_")[1]] = value
+        elif value and key not in ("chats", "waiting_messages"):
+            session[key] = decode_value(key, value)
+    state.restore(
+        decode_value("chats", loaded_data.get("chats")),
+        decode_value("waiting_messages", loaded_data.get("waiting_messages")),
+        session,
+    )
+    data_loaded = True
+
+    selected_chat = state.session.get("selected_chat")
+    if selected_chat:
+        _selected_chat_id = selected_chat.id
+        _materialize(selected_chat.id)
+
+    signal_manager.chats_changed.emit(state.chats)
+    if selected_chat:
+        signal_manager.selected_chat_changed.emit(selected_chat)
+    if state.session.get("sidebar_opened"):
+        signal_manager.sidebar_opened_changed.emit(state.session.get("sidebar_opened"))
 
 
 def set_instance(instance_number):
@@ -157,7 +563,31 @@ def set_instance(instance_number):
     instance = instance_number
 
 
+def close_data():
+    global _worker
+    for chat_id in list(state.histories.keys()):
+        archive_history(chat_id)
+    if _worker is not None:
+        _worker.stop()
+        _worker = None
+    if _store is not None:
+        _store.compact(wait=True)
+        _store.close()
+    for archive in _archives.values():
+        archive.close()
+
+
 def clear_data():
-    global data
-    data = []
-    os.remove(f"data{instance}.json")
+    global _worker
+    state.clear()
+    _unloaded.clear()
+    message_cache.clear()
+    for archive in _archives.values():
+        archive.close()
+    _archives.clear()
+    if os.path.exists(f"data{instance}_archive"):
+        shutil.rmtree(f"data{instance}_archive")
+    if _worker is not None:
+        _worker.stop(flush=False)
+        _worker = None
+    _get_store().clear()
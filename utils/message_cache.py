@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from typing import Iterable, List
+
+
+class MessageCache:
+    """
+    Bookkeeping for the chat histories held in gv: how many messages each chat
+    has in memory and in which order chats were last used. gv asks it which
+    chats to trim or evict and moves those messages to the archive.
+    """
+
+    def __init__(self, budget: int, chat_cap: int):
+        self.budget = budget
+        self.chat_cap = chat_cap
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.trimmed = 0
+
+    @property
+    def total(self) -> int:
+        return self._total
+
+    def hit(self, chat_id: str):
+        self.hits += 1
+        if chat_id in self._sizes:
+            self._sizes.move_to_end(chat_id)
+
+    def miss(self, chat_id: str):
+        self.misses += 1
+
+    def update(self, chat_id: str, size: int):
+        self._total += size - self._sizes.get(chat_id, 0)
+        self._sizes[chat_id] = size
+        self._sizes.move_to_end(chat_id)
+
+    def forget(self, chat_id: str):
+        self._total -= self._sizes.pop(chat_id, 0)
+
+    def over_cap(self, chat_id: str) -> bool:
+        return self._sizes.get(chat_id, 0) > self.chat_cap
+
+    def victims(self, protected: Iterable[str]) -> List[str]:
+        """Least recently used chats to drop so the total fits the budget again"""
+        protected = set(protected)
+        victims = []
+        total = self._total
+        for chat_id, size in self._sizes.items():
+            if total <= self.budget:
+                break
+            if chat_id in protected:
+                continue
+            victims.append(chat_id)
+            total -= size
+        return victims
+
+    def clear(self):
+        self._sizes.clear()
+        self._total = 0
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self._sizes),
+            "messages": self._total,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "trimmed": self.trimmed,
+        }
@@ -0,0 +1,183 @@
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from chat_types import MessageType
+
+
+def _time(message: MessageType) -> float:
+    return message.time
+
+
+class MessageCollection:
+    """
+    Messages of one chat ordered by time, with lookup by id.
+
+    Positions are found by bisecting on time, so inserting anywhere costs a
+    binary search plus the list shift, and lookups by id (or by the local id
+    a message was sent with) are a dict access. Appending newer messages and
+    prepending a page of older ones are the common cases and stay cheap.
+
+    Replies to a message the collection holds point at that message instead
+    of keeping their own copy of it.
+    """
+
+    def __init__(self, messages: Iterable[MessageType] = ()):
+        self._messages: List[MessageType] = sorted(messages, key=_time)
+        self._by_id: Dict[str, MessageType] = {}
+        self._aliases: Dict[str, str] = {}
+        self._index(self._messages)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[MessageType]:
+        return iter(self._messages)
+
+    def __getitem__(self, index):
+        return self._messages[index]
+
+    def __contains__(self, message_id):
+        return self.get(message_id) is not None
+
+    def __repr__(self):
+        return f"MessageCollection({len(self._messages)} messages)"
+
+    @property
+    def first(self) -> Optional[MessageType]:
+        return self._messages[0] if self._messages else None
+
+    @property
+    def last(self) -> Optional[MessageType]:
+        return self._messages[-1] if self._messages else None
+
+    def get(self, message_id: str) -> Optional[MessageType]:
+        """Message by id, or by the local id it was sent with before the server confirmed it"""
+        message = self._by_id.get(message_id)
+        if message is None and message_id in self._aliases:
+            message = self._by_id.get(self._aliases[message_id])
+        return message
+
+    def index(self, message_id: str) -> int:
+        message = self.get(message_id)
+        if message is None:
+            raise KeyError(message_id)
+        return self._position(message)
+
+    def add(self, message: MessageType) -> bool:
+        """Insert `message` or replace the one with the same id; True if it wasn't there"""
+        existing = self._by_id.get(message.id)
+        if existing is not None:
+            position = self._position(existing)
+            if existing.time == message.time:
+                self._messages[position] = message
+                self._by_id[message.id] = message
+                return False
+            del self._messages[position]
+
+        if not self._messages or self._messages[-1].time <= message.time:
+            self._messages.append(message)
+        else:
+            self._messages.insert(bisect_right(self._messages, message.time, key=_time), message)
+        self._index([message])
+        return existing is None
+
+    def extend(self, messages: Iterable[MessageType]) -> List[MessageType]:
+        """Add many messages, returns the ones that weren't there"""
+        messages = sorted(messages, key=_time)
+        if messages and self._messages and not any(message.id in self._by_id for message in messages):
+            if messages[-1].time < self._messages[0].time:
+                self.prepend(messages)
+                return messages
+            if messages[0].time >= self._messages[-1].time:
+                self._append_sorted(messages)
+                return messages
+        return [message for message in messages if self.add(message)]
+
+    def prepend(self, messages: List[MessageType]):
+        """Put a page of messages older than everything held in front, in one list operation"""
+        messages = [message for message in sorted(messages, key=_time) if message.id not in self._by_id]
+        if self._messages and messages and messages[-1].time > self._messages[0].time:
+            # not strictly older, fall back to ordered inserts
+            for message in messages:
+                self.add(message)
+            return
+        self._messages[:0] = messages
+        self._index(messages)
+
+    def remove(self, message_id: str) -> Optional[MessageType]:
+        message = self.get(message_id)
+        if message is None:
+            return None
+        del self._messages[self._position(message)]
+        del self._by_id[message.id]
+        if message.local_id and self._aliases.get(message.local_id) == message.id:
+            del self._aliases[message.local_id]
+        return message
+
+    def rename(self, old_id: str, new_id: str) -> Optional[MessageType]:
+        """Give the message known as `old_id` (usually its local id) the id the server assigned"""
+        message = self._by_id.pop(old_id, None)
+        if message is None:
+            return None
+        message.id = new_id
+        message.local_id = message.local_id or old_id
+        self._by_id[new_id] = message
+        if old_id != new_id:
+            self._aliases[old_id] = new_id
+        return message
+
+    def set_text(self, message_id: str, text: str) -> Optional[MessageType]:
+        message = self.get(message_id)
+        if message is not None:
+            message.text = text
+        return message
+
+    def set_status(self, message_id: str, status: str) -> Optional[MessageType]:
+        message = self.get(message_id)
+        if message is not None:
+            message.status = status
+        return message
+
+    def mark_read(self, message_ids: Iterable[str]) -> List[MessageType]:
+        """Mark messages read, returns the ones that weren't"""
+        changed = []
+        for message_id in message_ids:
+            message = self.get(message_id)
+            if message is not None and message.status != "read":
+                message.status = "read"
+                changed.append(message)
+        return changed
+
+    def before(self, time: Optional[float], limit: int) -> List[MessageType]:
+        """Up to `limit` newest messages older than `time`, oldest first"""
+        end = len(self._messages) if time is None else bisect_left(self._messages, time, key=_time)
+        return self._messages[max(end - limit, 0):end]
+
+    def between(self, start: float, end: float) -> List[MessageType]:
+        """Messages with start <= time < end"""
+        return self._messages[bisect_left(self._messages, start, key=_time):bisect_left(self._messages, end, key=_time)]
+
+    def newest(self, count: int) -> List[MessageType]:
+        return self._messages[max(len(self._messages) - count, 0):] if count else []
+
+    def _position(self, message: MessageType) -> int:
+        # several messages can share a timestamp, the id may have changed in place
+        position = bisect_left(self._messages, message.time, key=_time)
+        while self._messages[position] is not message:
+            position += 1
+        return position
+
+    def _append_sorted(self, messages: List[MessageType]):
+        self._messages.extend(messages)
+        self._index(messages)
+
+    def _index(self, messages: List[MessageType]):
+        by_id = self._by_id
+        for message in messages:
+            by_id[message.id] = message
+            if message.local_id and message.local_id != message.id:
+                self._aliases[message.local_id] = message.id
+        for message in messages:
+            reply_to = message.reply_to
+            if reply_to is not None and reply_to.id in by_id:
+                message.reply_to = by_id[reply_to.id]
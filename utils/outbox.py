@@ -0,0 +1,121 @@
+import time
+from typing import Callable, Dict
+
+from chat_types import MessageType
+from lib.backoff import Backoff
+from utils.state import Change, State
+
+
+class Outbox:
+    """
+    Sends the messages waiting in `state.outbox` until the server confirms them.
+
+    The outbox itself lives in State and is persisted with it, so drafts
+    survive restarts. Messages go out in the order they were written as
+    `new_message` frames carrying their local id, one unacknowledged message
+    per chat and up to `max_in_flight` across all chats. The server
+    confirming a local id removes the message from the outbox, which is the
+    acknowledgement, and lets the chat's next one go. A message that isn't
+    acknowledged within `ack_timeout` is sent again with the same local id
+    after a backoff, nothing newer of its chat is on the way meanwhile, so a
+    chat's messages can't overtake each other.
+    """
+
+    def __init__(
+        self,
+        state: State,
+        send: Callable[[dict], None],
+        online: Callable[[], bool],
+        max_in_flight: int = 32,
+        ack_timeout: float = 10.0,
+        retry_base: float = 1.0,
+        retry_cap: float = 60.0,
+    ):
+        self.state = state
+        self.send = send
+        self.online = online
+        self.max_in_flight = max_in_flight
+        self.ack_timeout = ack_timeout
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+
+        # local id -> when it was sent, or when it may be sent again
+        self._in_flight: Dict[str, float] = {}
+        self._retry_at: Dict[str, float] = {}
+        self._backoffs: Dict[str, Backoff] = {}
+
+        self.sent = 0
+        self.acked = 0
+        self.retries = 0
+        state.subscribe(self._on_outbox_change, "outbox")
+
+    def start(self):
+        """The session is (re)authenticated: everything unacknowledged goes out again, right away"""
+        self._in_flight.clear()
+        self._retry_at.clear()
+        self._backoffs.clear()
+        self.flush()
+
+    def flush(self):
+        if not self.online():
+            return
+        now = time.monotonic()
+        for local_id, sent_at in list(self._in_flight.items()):
+            if now - sent_at > self.ack_timeout:
+                del self._in_flight[local_id]
+                backoff = self._backoffs.setdefault(local_id, Backoff(self.retry_base, self.retry_cap))
+                self._retry_at[local_id] = now + backoff.next_delay()
+
+        # chats with a message on the way or waiting for its retry, nothing newer goes out before it's acknowledged
+        blocked = set()
+        for message in list(self.state.outbox):
+            if len(self._in_flight) >= self.max_in_flight:
+                break
+            if message.chat_id in blocked:
+                continue
+            blocked.add(message.chat_id)
+            if message.id in self._in_flight or self._retry_at.get(message.id, 0) > now:
+                continue
+            if message.id in self._retry_at:
+                del self._retry_at[message.id]
+                self.retries += 1
+            self._in_flight[message.id] = now
+            self.sent += 1
+            self.send(new_message_frame(message))
+
+    def _on_outbox_change(self, change: Change):
+        waiting = {message.id for message in self.state.outbox}
+        for local_id in [local_id for local_id in self._in_flight if local_id not in waiting]:
+            del self._in_flight[local_id]
+            self._backoffs.pop(local_id, None)
+            self.acked += 1
+        for local_id in [local_id for local_id in self._retry_at if local_id not in waiting]:
+            del self._retry_at[local_id]
+            self._backoffs.pop(local_id, None)
+        self.flush()
+
+    def stats(self) -> dict:
+        outbox = list(self.state.outbox)
+        oldest = min((message.time for message in outbox), default=None)
+        return {
+            "depth": len(outbox),
+            "in_flight": len(self._in_flight),
+            "waiting_retry": len(self._retry_at),
+            "oldest_age_s": round(time.time() - oldest, 1) if oldest else 0.0,
+            "sent": self.sent,
+            "acked": self.acked,
+            "retries": self.retries,
+        }
+
+
+def new_message_frame(message: MessageType) -> dict:
+    return {
+        "action": "new_message",
+        "data": {
+            "text": message.text,
+            "chat_id": message.chat_id,
+            "reply_to": message.reply_to.id if message.reply_to else None,
+            "timestamp": message.time,
+            "local_id": message.id,
+        },
+    }
@@ -0,0 +1,89 @@
+from typing import Dict, List, Optional
+
+from chat_types import ChatType, MessageType, UserType
+
+
+class PayloadDecoder:
+    """
+    Turns decoded frames into domain objects before they reach the GUI thread.
+
+    `decode(frame)` runs on the connection thread and stores the objects an
+    action needs under `frame["decoded"]`, so ActionHandler only applies them.
+    It is None for actions with nothing to decode and for frames that failed.
+    Frames are decoded in the order they arrive, the user id `is_mine` is
+    computed against is taken from `authenticate` frames as they pass.
+    """
+
+    def __init__(self, user_id: Optional[str] = None):
+        self.user_id = user_id
+
+    def decode(self, frame: dict) -> dict:
+        decoder = getattr(self, f"_{frame.get('action')}", None)
+        data = frame.get("data") or {}
+        frame["decoded"] = None
+        if decoder is not None:
+            try:
+                frame["decoded"] = decoder(data)
+            except Exception as e:
+                print("Error decoding frame:", frame.get("action"), e)
+        return frame
+
+    def message(self, data: dict) -> MessageType:
+        reply_to = data.get("reply_to")
+        if isinstance(reply_to, dict):
+            reply_to = self.message(reply_to)
+        return MessageType(**{**data, "is_mine": data.get("sender") == self.user_id, "reply_to": reply_to})
+
+    def messages(self, rows: List[dict]) -> List[MessageType]:
+        messages = [self.message(row) for row in rows]
+        by_id = {message.id: message for message in messages}
+        for message in messages:
+            # a reply to a message of the same page points at that message
+            if message.reply_to is not None and message.reply_to.id in by_id:
+                message.reply_to = by_id[message.reply_to.id]
+        return messages
+
+    def _authenticate(self, data: dict):
+        user = data.get("user") or {}
+        if user.get("id"):
+            self.user_id = user["id"]
+        return None
+
+    def _search_users(self, data: dict) -> List[UserType]:
+        return [UserType(**user) for user in data.get("results") or []]
+
+    def _get_chats(self, data: dict) -> List[ChatType]:
+        return [
+            ChatType(
+                user=UserType(**chat.get("user")),
+                id=chat.get("id"),
+                last_message=chat.get("last_message"),
+                updated_at=chat.get("updated_at"),
+            )
+            for chat in data.get("results") or []
+        ]
+
+    def _get_messages(self, data: dict) -> List[MessageType]:
+        return self.messages(data.get("results") or [])
+
+    def _new_message(self, data: dict) -> Optional[MessageType]:
+        message = data.get("message")
+        return self.message(message) if message else None
+
+    def _get_updates(self, data: dict) -> Dict[str, list]:
+        grouped: Dict[str, list] = {}
+        for update in data.get("updates") or []:
+            body = update.get("body") or {}
+            kind = update.get("type")
+            if kind == "new_message":
+                message = self.message(body.get("message"))
+                grouped.setdefault(message.chat_id, []).append({"type": kind, "message": message})
+            elif kind == "delete_message":
+                grouped.setdefault(body.get("chat_id"), []).append({"type": kind, "message_id": body.get("message_id")})
+            elif kind == "edit_message":
+                grouped.setdefault(body.get("chat_id"), []).append(
+                    {"type": kind, "message_id": body.get("message_id"), "text": body.get("text")}
+                )
+            elif kind == "read_message":
+                grouped.setdefault(body.get("chat_id"), []).append({"type": kind, "message_ids": body.get("message_ids")})
+        return grouped
@@ -0,0 +1,428 @@
+import traceback
+from dataclasses import dataclass, field
+from threading import RLock
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from chat_types import ChatType, MessageType, UserType
+from utils.chat_index import ChatIndex
+from utils.message_collection import MessageCollection
+
+
+@dataclass
+class MessagesChange:
+    # every message written, keyed by id; `added` and `prepended` are the new ones
+    upserted: Dict[str, MessageType] = field(default_factory=dict)
+    removed: Set[str] = field(default_factory=set)
+    added: Dict[str, MessageType] = field(default_factory=dict)
+    # new messages older than everything the chat held, e.g. a page of history
+    prepended: Dict[str, MessageType] = field(default_factory=dict)
+    # new id -> local id of messages the server confirmed
+    renamed: Dict[str, str] = field(default_factory=dict)
+    has_more: bool = False
+    replaced: bool = False
+    # ids of messages that were read back from local storage, not to be written again
+    transient_ids: Set[str] = field(default_factory=set)
+
+    def merge(self, later: "MessagesChange"):
+        """Fold a change that happened after this one into it"""
+        unseen = set()
+        for message_id, local_id in later.renamed.items():
+            for new in (self.added, self.prepended):
+                if local_id in new:
+                    # added earlier in the same batch, nobody saw the local id
+                    new[message_id] = new.pop(local_id)
+                    self.upserted.pop(local_id, None)
+                    unseen.add(local_id)
+                    break
+            else:
+                self.renamed[message_id] = self.renamed.pop(local_id, local_id)
+        for message_id in later.removed - unseen:
+            self.transient_ids.discard(message_id)
+            self.upserted.pop(message_id, None)
+            self.added.pop(message_id, None)
+            self.prepended.pop(message_id, None)
+            self.removed.add(message_id)
+        for message_id, message in later.upserted.items():
+            self.removed.discard(message_id)
+            self.upserted[message_id] = message
+        self.added.update(later.added)
+        self.prepended.update(later.prepended)
+        self.has_more = self.has_more or later.has_more
+        self.replaced = self.replaced or later.replaced
+        # written for real later on, it has to be stored after all
+        self.transient_ids -= later.upserted.keys() - later.transient_ids
+        self.transient_ids |= later.transient_ids
+
+
+@dataclass
+class Change:
+    chats: bool = False
+    chat_ids: Set[str] = field(default_factory=set)
+    # (chat id, from, to) in the order the chats moved in the recency order
+    moved: List[Tuple[str, int, int]] = field(default_factory=list)
+    user_ids: Set[str] = field(default_factory=set)
+    messages: Dict[str, MessagesChange] = field(default_factory=dict)
+    outbox: bool = False
+    session: Set[str] = field(default_factory=set)
+
+    def __bool__(self):
+        return bool(self.chats or self.chat_ids or self.user_ids or self.messages or self.outbox or self.session)
+
+    def merge(self, later: "Change"):
+        self.chats = self.chats or later.chats
+        self.chat_ids.update(later.chat_ids)
+        self.moved.extend(later.moved)
+        self.user_ids.update(later.user_ids)
+        for chat_id, messages_change in later.messages.items():
+            if chat_id in self.messages:
+                self.messages[chat_id].merge(messages_change)
+            else:
+                self.messages[chat_id] = messages_change
+        self.outbox = self.outbox or later.outbox
+        self.session.update(later.session)
+
+    def messages_for(self, chat_id: str) -> MessagesChange:
+        if chat_id not in self.messages:
+            self.messages[chat_id] = MessagesChange()
+        return self.messages[chat_id]
+
+
+@dataclass
+class _Subscription:
+    callback: Callable[[Change], None]
+    topic: Optional[str]
+    key: Optional[str]
+
+
+class State:
+    """
+    Typed client state: chats, users, per chat message histories, the outbox of
+    messages waiting to be sent and session values.
+
+    Every mutation goes through a method here and is recorded in a Change.
+    Mutations inside `with state.transaction():` are merged and subscribers are
+    called once when the outermost transaction ends, only if the change touches
+    the topic (and key) they subscribed to.
+
+    With `defer` set, committed changes are held back and merged instead:
+    `defer()` is called for the first one and whoever set it calls `flush()`
+    later, e.g. on the next event loop iteration, to dispatch them as one.
+    """
+
+    TOPICS = ("chats", "chat", "user", "messages", "outbox", "session")
+
+    def __init__(self):
+        self.chat_index = ChatIndex()
+        self.users: Dict[str, UserType] = {}
+        self.histories: Dict[str, dict] = {}
+        self.outbox: List[MessageType] = []
+        self.session: dict = {}
+
+        self._lock = RLock()
+        self._depth = 0
+        self._change = Change()
+        self._subscriptions: List[_Subscription] = []
+        self._pending: Optional[Change] = None
+        self.defer: Optional[Callable[[], None]] = None
+        # called with a chat id before a history that isn't in memory is first touched
+        self.history_loader: Optional[Callable[[str], None]] = None
+        # MessageCollection or ColumnarMessageCollection, they share one interface
+        self.collection_factory: Callable[..., MessageCollection] = MessageCollection
+
+    def subscribe(self, callback: Callable[[Change], None], topic: Optional[str] = None, key: Optional[str] = None):
+        """Call `callback(change)` after transactions touching `topic`/`key`; no topic means every change"""
+        if topic is not None and topic not in self.TOPICS:
+            raise ValueError(f"unknown topic {topic}")
+        subscription = _Subscription(callback, topic, key)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: _Subscription):
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    def transaction(self):
+        return _Transaction(self)
+
+    def flush(self):
+        """Dispatch changes held back by `defer`"""
+        with self._lock:
+            change, self._pending = self._pending, None
+        if change:
+            self._dispatch(change)
+
+    # loading, no change events
+
+    def restore(self, chats: List[ChatType], outbox: List[MessageType], session: dict):
+        with self._lock:
+            self.session.update(session)
+            self._set_chats(chats)
+            self.outbox = list(outbox)
+
+    def load_history(self, chat_id: str, value: dict):
+        with self._lock:
+            self.histories[chat_id] = self._as_history(value)
+
+    def drop_history(self, chat_id: str):
+        with self._lock:
+            self.histories.pop(chat_id, None)
+
+    def clear(self):
+        with self._lock:
+            self.chat_index, self.users, self.histories = ChatIndex(), {}, {}
+            self.outbox = []
+            self.session = {}
+            self._pending = None
+
+    # chats and users
+
+    @property
+    def chats(self) -> List[ChatType]:
+        """Chats ordered by recent activity, newest first"""
+        return self.chat_index.ordered()
+
+    @property
+    def chats_by_id(self) -> Dict[str, ChatType]:
+        return self.chat_index.by_id
+
+    def set_chats(self, chats: List[ChatType]):
+        with self.transaction() as change:
+            self._set_chats(chats)
+            change.chats = True
+
+    def update_chat(self, chat_id: str, **fields):
+        with self.transaction() as change:
+            chat = self.chat_index.get(chat_id)
+            if chat:
+                updated_at = fields.pop("updated_at", None)
+                for name, value in fields.items():
+                    setattr(chat, name, value)
+                if updated_at is not None:
+                    self._touch_chat(change, chat_id, updated_at)
+                change.chat_ids.add(chat_id)
+
+    def update_user(self, user_id: str, **fields):
+        with self.transaction() as change:
+            user = self.users.get(user_id)
+            if user:
+                for name, value in fields.items():
+                    setattr(user, name, value)
+                change.user_ids.add(user_id)
+                change.chat_ids.update(chat.id for chat in self.chat_index.chats_for_user(user_id))
+
+    # session
+
+    def set_session(self, key: str, value):
+        with self.transaction() as change:
+            self.session[key] = value
+            if key == "selected_chat" and value is not None:
+                # keep the selection pointing at the live chat object
+                self.session[key] = self.chats_by_id.get(value.id, value)
+            change.session.add(key)
+
+    # outbox
+
+    def set_outbox(self, messages: List[MessageType]):
+        with self.transaction() as change:
+            self.outbox = list(messages)
+            change.outbox = True
+
+    def add_to_outbox(self, message: MessageType):
+        with self.transaction() as change:
+            self.outbox.append(message)
+            change.outbox = True
+
+    def remove_from_outbox(self, message_id: str):
+        with self.transaction() as change:
+            outbox = [message for message in self.outbox if message.id != message_id]
+            if len(outbox) != len(self.outbox):
+                self.outbox = outbox
+                change.outbox = True
+
+    # messages
+
+    def replace_history(self, chat_id: str, value: dict):
+        with self.transaction() as change:
+            self.histories[chat_id] = self._as_history(value)
+            change.messages_for(chat_id).replaced = True
+
+    def upsert_messages(self, chat_id: str, messages: Iterable[MessageType], has_more: Optional[bool] = None, persist: bool = True):
+        with self.transaction() as change:
+            history = self._history(chat_id)
+            chat_change = change.messages_for(chat_id)
+
+            collection: MessageCollection = history["messages"]
+            oldest = collection.first.time if collection.first else None
+            messages = list(messages)
+            if persist:
+                chat_change.transient_ids.difference_update(message.id for message in messages)
+            else:
+                chat_change.transient_ids.update(message.id for message in messages)
+            new_ids = {message.id for message in collection.extend(messages)}
+            for message in messages:
+                if message.id in new_ids:
+                    if oldest is None or message.time < oldest:
+                        chat_change.prepended[message.id] = message
+                    else:
+                        chat_change.added[message.id] = message
+                chat_change.removed.discard(message.id)
+                chat_change.upserted[message.id] = message
+
+            # a message newer than the chat's last activity moves the chat to the top
+            latest = max((message for message in messages if message.id in new_ids), key=lambda message: message.time, default=None)
+            chat = self.chat_index.get(chat_id)
+            if latest is not None and chat is not None and latest.time > (chat.updated_at or 0):
+                chat.last_message = latest.text
+                self._touch_chat(change, chat_id, latest.time)
+                change.chat_ids.add(chat_id)
+
+            if has_more is not None and has_more != history.get("has_more"):
+                history["has_more"] = has_more
+                chat_change.has_more = True
+
+    def confirm_message(self, chat_id: str, local_id: str, message_id: str, status: str) -> bool:
+        """The server accepted a message sent with `local_id` and gave it `message_id`; False if it isn't ours"""
+        with self.transaction() as change:
+            sent = next((message for message in self.outbox if message.id == local_id), None)
+            self.remove_from_outbox(local_id)
+            collection: MessageCollection = self._history(chat_id)["messages"]
+            confirmed = collection.get(local_id)
+            if confirmed is not None and confirmed.id == message_id:
+                # confirmed twice, a resend the server had already taken
+                return True
+            if collection.rename(local_id, message_id):
+                message = collection.set_status(message_id, status)
+                if sent is not None and sent is not message:
+                    # the columnar backend keeps rows, not the object that was sent, rename that one too
+                    sent.id, sent.local_id, sent.status = message_id, sent.local_id or local_id, status
+                chat_change = change.messages_for(chat_id)
+                chat_change.upserted.pop(local_id, None)
+                chat_change.removed.add(local_id)
+                chat_change.upserted[message_id] = message
+                for new in (chat_change.added, chat_change.prepended):
+                    if new.pop(local_id, None):
+                        # added in this same transaction, nobody saw the local id
+                        chat_change.removed.discard(local_id)
+                        new[message_id] = message
+                        break
+                else:
+                    chat_change.renamed[message_id] = chat_change.renamed.pop(local_id, local_id)
+                return True
+            return False
+
+    def edit_message(self, chat_id: str, message_id: str, text: str):
+        with self.transaction() as change:
+            message = self._history(chat_id)["messages"].set_text(message_id, text)
+            if message:
+                change.messages_for(chat_id).upserted[message.id] = message
+
+    def mark_read(self, chat_id: str, message_ids: Iterable[str]):
+        with self.transaction() as change:
+            for message in self._history(chat_id)["messages"].mark_read(message_ids):
+                change.messages_for(chat_id).upserted[message.id] = message
+
+    def remove_messages(self, chat_id: str, message_ids: Iterable[str]):
+        with self.transaction() as change:
+            collection: MessageCollection = self._history(chat_id)["messages"]
+            chat_change = change.messages_for(chat_id)
+            for message_id in message_ids:
+                collection.remove(message_id)
+                chat_change.upserted.pop(message_id, None)
+                chat_change.added.pop(message_id, None)
+                chat_change.prepended.pop(message_id, None)
+                chat_change.renamed.pop(message_id, None)
+                chat_change.removed.add(message_id)
+
+    def _history(self, chat_id: str) -> dict:
+        if chat_id not in self.histories and self.history_loader:
+            self.history_loader(chat_id)
+        if chat_id not in self.histories:
+            self.histories[chat_id] = {"messages": self.collection_factory(), "has_more": False}
+        return self.histories[chat_id]
+
+    def new_collection(self, messages: Iterable[MessageType] = ()) -> MessageCollection:
+        return self.collection_factory(messages)
+
+    def _as_history(self, value: dict) -> dict:
+        if not isinstance(value.get("messages"), self.collection_factory):
+            value["messages"] = self.collection_factory(value.get("messages", []))
+        return value
+
+    def _touch_chat(self, change: Change, chat_id: str, updated_at: float):
+        moved = self.chat_index.touch(chat_id, updated_at)
+        if moved:
+            change.moved.append((chat_id, *moved))
+
+    def _set_chats(self, chats: List[ChatType]):
+        self.chat_index.reset(chats)
+        for chat in self.chat_index:
+            if chat.user:
+                self.users[chat.user.id] = chat.user
+        selected_chat = self.session.get("selected_chat")
+        if selected_chat is not None and selected_chat.id in self.chats_by_id:
+            self.session["selected_chat"] = self.chats_by_id[selected_chat.id]
+
+    def _commit(self, change: Change):
+        if self.defer is None:
+            self._dispatch(change)
+            return
+        with self._lock:
+            first = self._pending is None
+            if first:
+                self._pending = change
+            else:
+                self._pending.merge(change)
+        if first:
+            self.defer()
+
+    def _dispatch(self, change: Change):
+        for subscription in list(self._subscriptions):
+            if self._matches(subscription, change):
+                try:
+                    subscription.callback(change)
+                except Exception as e:
+                    print(traceback.format_exc())
+                    print("Error in state subscriber:", e)
+
+    @staticmethod
+    def _matches(subscription: _Subscription, change: Change) -> bool:
+        topic, key = subscription.topic, subscription.key
+        if topic is None:
+            return True
+        if topic == "chats":
+            return change.chats
+        if topic == "outbox":
+            return change.outbox
+        keys = {
+            "chat": change.chat_ids,
+            "user": change.user_ids,
+            "messages": change.messages,
+            "session": change.session,
+        }[topic]
+        return key in keys if key is not None else bool(keys)
+
+
+class _Transaction:
+    def __init__(self, state: State):
+        self.state = state
+
+    def __enter__(self) -> Change:
+        self.state._lock.acquire()
+        self.state._depth += 1
+        return self.state._change
+
+    def __exit__(self, exc_type, exc, tb):
+        state = self.state
+        state._depth -= 1
+        change = None
+        if state._depth == 0:
+            change, state._change = state._change, Change()
+        state._lock.release()
+
+        if change and exc_type is not None:
+            # there's no rollback, but a half done change isn't announced or persisted either
+            print("State transaction failed, change dropped:", exc)
+            return
+        # subscribers run outside the lock so they can take their own locks
+        if change:
+            state._commit(change)